@@ -0,0 +1,87 @@
+'''
+Size- and age-bounded cache directories under Util.cache_root(), evicting the least recently used files.
+A file is used when it is written or touched. Files being written are named *.tmp*, and never evicted.
+'''
+
+import os
+import threading
+import time
+from pathlib import Path
+from collections.abc import Collection
+from typing import NamedTuple, Optional
+
+from src.lib.Util import cache_root
+
+
+class Policy(NamedTuple):
+    max_bytes: Optional[int]  = 4 * 2**30  # total size of the directory
+    max_age: Optional[float]  = None       # [s] since last use
+
+
+AGE_CHECK_INTERVAL = 60  # [s] between scans of a directory by evict_if_full, when its policy has a max_age
+
+# directory: (estimated size, time of the last scan), for evict_if_full
+usage: dict[Path, tuple[int, float]] = {}
+usage_lock = threading.Lock()
+
+
+def cache_dir(name: str) -> Path:
+    directory = cache_root() / name
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
+def touch(path: Path) -> None:
+    '''Mark path as used, for eviction.'''
+    try:
+        os.utime(path)
+    except OSError:
+        pass  # evicted meanwhile
+
+def evict(directory: Path, policy: Policy = Policy(), keep: Collection[Path] = ()) -> list[Path]:
+    '''Remove files of directory until it satisfies policy, least recently used first. Returns the removed files.
+    keep: files that are never removed (but count towards the size), e.g. still referenced elsewhere.'''
+    entries = []
+    pinned  = 0
+    for path in directory.iterdir():
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        if not path.is_file() or '.tmp' in path.suffixes:
+            continue
+        if path in keep:
+            pinned += stat.st_size
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    entries.sort()
+    total   = pinned + sum(size for _, size, _ in entries)
+    now     = time.time()
+    removed = []
+
+    for mtime, size, path in entries:
+        expired  = policy.max_age is not None and now - mtime > policy.max_age
+        too_big  = policy.max_bytes is not None and total > policy.max_bytes
+        if not (expired or too_big):
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+        removed.append(path)
+
+    with usage_lock:
+        usage[directory] = (total, now)
+    return removed
+
+def evict_if_full(directory: Path, added: int, policy: Policy = Policy()) -> list[Path]:
+    '''Like evict, after writing added bytes to directory, without scanning it every time:
+    only once the size estimated since the last scan may exceed policy.max_bytes (or every AGE_CHECK_INTERVAL with max_age).
+    Files written by other processes are only counted at the next scan.'''
+    with usage_lock:
+        total, scanned = usage.get(directory, (None, 0.0))
+        if total is not None:
+            total += added
+            usage[directory] = (total, scanned)
+
+    within_size = total is not None and (policy.max_bytes is None or total <= policy.max_bytes)
+    within_age  = policy.max_age is None or time.time() - scanned < AGE_CHECK_INTERVAL
+    return [] if within_size and within_age else evict(directory, policy)
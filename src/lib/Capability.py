@@ -0,0 +1,127 @@
+'''
+What a feram binary can do, from `feram -v`, cached on disk across runs.
+
+The cache maps a binary's path to its (mtime, size, sha256), and a sha256 to the probed capabilities,
+so the binary is only hashed when it changed and only run when its content is new.
+'''
+
+import hashlib
+import json
+import os
+import subprocess as sub
+import threading
+from pathlib import Path
+from typing import Any, NamedTuple
+
+from result import Result, Ok, Err
+
+from src.lib.Util import cache_root
+
+
+FEATURES = ('json_log',)  # features recognized in the version string
+
+
+class Capabilities(NamedTuple):
+    version: str
+    sha256: str
+    features: frozenset[str]
+
+    def supports(self, feature: str) -> bool:
+        return feature in self.features
+
+
+def cache_file() -> Path:
+    return cache_root() / 'feram_capabilities.json'
+
+def sha256(path: Path, block_size: int = 2**20) -> str:
+    digest = hashlib.sha256()
+    with path.open('rb') as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+def parse_version(version: str, sha256: str) -> Capabilities:
+    return Capabilities(
+        version  = version.strip(),
+        sha256   = sha256,
+        features = frozenset(feature for feature in FEATURES if feature in version)
+    )
+
+
+lock = threading.Lock()
+memo: dict[tuple[Path, int, int], Capabilities] = {}  # (path, mtime_ns, size): ...
+
+def is_valid(cache: Any) -> bool:
+    '''cache has the layout written by store, e.g. not a file of an older or foreign format.'''
+    def entries(key: str, fields: dict[str, type]) -> bool:
+        return isinstance(cache.get(key), dict) and all(
+            isinstance(entry, dict) and all(isinstance(entry.get(field), kind) for field, kind in fields.items())
+            for entry in cache[key].values()
+        )
+
+    return (isinstance(cache, dict)
+            and entries('paths', {'mtime_ns': int, 'size': int, 'sha256': str})
+            and entries('binaries', {'version': str}))
+
+def load() -> dict:
+    try:
+        cache = json.loads(cache_file().read_text())
+    except (OSError, ValueError):
+        cache = None
+    return cache if is_valid(cache) else {'paths': {}, 'binaries': {}}
+
+def store(cache: dict):
+    # other processes may read concurrently, so replace the file atomically
+    path = cache_file()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp  = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}')
+    tmp.write_text(json.dumps(cache, indent=2))
+    tmp.replace(path)
+
+def probe(feram_bin: Path) -> Result[Capabilities, str]:
+    '''Capabilities of feram_bin; `feram -v` only runs for a binary not seen before.'''
+    try:
+        path = feram_bin.resolve()
+        stat = path.stat()
+        key  = (path, stat.st_mtime_ns, stat.st_size)
+
+        with lock:
+            if key in memo:
+                return Ok(memo[key])
+
+            cache = load()
+            entry = cache['paths'].get(str(path))
+
+            if entry and (entry['mtime_ns'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+                digest = entry['sha256']
+            else:
+                digest = sha256(path)
+
+            if digest in cache['binaries']:
+                version = cache['binaries'][digest]['version']
+            else:
+                completed = sub.run([path, '-v'], capture_output=True, universal_newlines=True)
+                if completed.returncode != 0:
+                    return Err(f'{path} -v returned error code {completed.returncode}:\n{completed.stderr}')
+                version = completed.stdout
+
+            capabilities = parse_version(version, digest)
+            path_entry   = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': digest}
+            bin_entry    = {'version': version, 'features': sorted(capabilities.features)}
+
+            if (entry, cache['binaries'].get(digest)) != (path_entry, bin_entry):
+                cache['paths'][str(path)] = path_entry
+                cache['binaries'][digest] = bin_entry
+                store(cache)
+
+            memo[key] = capabilities
+            return Ok(capabilities)
+    except OSError as e:
+        return Err(str(e))
+
+
+if __name__ == "__main__":
+    import sys
+
+    for arg in sys.argv[1:]:
+        print(arg, probe(Path(arg)))
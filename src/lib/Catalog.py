@@ -0,0 +1,256 @@
+'''
+Index of the runs under project_root()/output, one row per run, and lazy scans over the runs it selects.
+
+A run is a directory with _artifacts/{sim_name}.parquet, or the .tar.gz Archive made of one. Its metadata is read
+from the .feram files (of the run, or of every stage directory of ECE), thermo.avg and coords/.
+The index is kept in the cache and only runs that changed since are read again.
+
+catalog = build_catalog(archives=True)
+catalog.runs(pl.col('material') == 'BTO')
+catalog.scan(pl.col('structure') == 'film').filter(pl.col('kelvin') > 300).collect()
+'''
+
+import json
+import sys
+import tarfile
+import zlib
+import polars as pl
+from pathlib import Path
+from collections.abc import Iterator, Sequence
+from typing import Any, NamedTuple, Optional
+from result import Err
+
+from src.lib.Cache import Policy, cache_dir, evict
+from src.lib.Config import Material, parse_feram_file
+from src.lib.Materials import BST, BTO, KNO, PTO
+from src.lib.Schema import AVG_SCHEMA
+from src.lib.Tables import parse_lines, read_lines
+from src.lib.Util import cache_root, content_key, print_result, project_root
+
+
+MATERIALS: dict[str, Material] = {'BTO': BTO, 'BST': BST, 'KNO': KNO, 'PTO': PTO}
+
+CATALOG_SCHEMA: dict[str, pl.DataType | pl.DataTypeClass] = {
+    'run':        pl.String,                # name of the directory
+    'source':     pl.String,                # the directory or the archive
+    'archived':   pl.Boolean,
+    'mtime_ns':   pl.Int64,                 # of source (archive) or of the run's parquet (directory)
+    'sim_name':   pl.String,
+    'kind':       pl.String,                # temperature, ece
+    'material':   pl.String,                # name in MATERIALS, null if none matches
+    'structure':  pl.String,                # bulk_or_film
+    'method':     pl.String,
+    'L':          pl.List(pl.Int64),
+    'E_field':    pl.List(pl.Float64),      # external_E_field, null if not set
+    'stages':     pl.List(pl.String),       # stage directories of ECE
+    'kelvins':    pl.List(pl.Float64),      # every temperature of the run
+    'kelvin_min': pl.Float64,
+    'kelvin_max': pl.Float64,
+    'config':     pl.String,                # JSON: {stage: {key: value}} of the .feram files, stage '' for the run itself
+    'parquet':    pl.String,                # readable {sim_name}.parquet (extracted from archives)
+    'stats':      pl.String,                # readable {sim_name}.stats.parquet, null if none
+}
+
+
+class RunFiles(NamedTuple):
+    sim_name: str
+    ferams: dict[str, str]    # stage ('' for the run itself) -> .feram text
+    avg: Optional[bytes]      # thermo.avg
+    coords: list[str]         # names in coords/
+    parquet: Path
+    stats: Optional[Path]
+
+
+def is_stats(path: str | Path) -> bool:
+    return str(path).endswith('.stats.parquet')
+
+def dir_files(run_dir: Path) -> Optional[RunFiles]:
+    parquets = sorted(p for p in (run_dir / '_artifacts').glob('*.parquet') if not is_stats(p))
+    if not parquets:
+        return None
+
+    sim_name = parquets[0].stem
+    stats    = parquets[0].with_name(f'{sim_name}.stats.parquet')
+    ferams   = [run_dir / f'{sim_name}.feram', *run_dir.glob(f'*/{sim_name}.feram')]
+    thermo   = run_dir / 'thermo.avg'
+
+    return RunFiles(
+        sim_name = sim_name,
+        ferams   = {'' if f.parent == run_dir else f.parent.name: f.read_text() for f in ferams if f.is_file()},
+        avg      = thermo.read_bytes() if thermo.is_file() else None,
+        coords   = [p.name for p in (run_dir / 'coords').glob('*.coord')],
+        parquet  = parquets[0],
+        stats    = stats if stats.is_file() else None,
+    )
+
+def archive_files(archive: Path, extract_dir: Path) -> Optional[RunFiles]:
+    '''Read the archive once, extracting its parquet files to extract_dir.'''
+    key      = content_key(str(archive.resolve()), archive.stat().st_mtime_ns)[:32]
+    ferams   = {}
+    avg      = None
+    coords   = []
+    parquets = {}
+
+    with tarfile.open(archive, 'r:gz') as tar:  # 'r|gz' stops after the first gzip member, older archives have several
+        for member in tar:
+            parts = Path(member.name).parts[1:]  # below the run directory
+            if not member.isfile() or not parts:
+                continue
+
+            if len(parts) == 2 and parts[0] == '_artifacts' and parts[1].endswith('.parquet'):
+                path = extract_dir / f'{key}.{parts[1]}'
+                path.write_bytes(tar.extractfile(member).read())
+                parquets[parts[1]] = path
+            elif len(parts) <= 2 and parts[-1].endswith('.feram') and parts[0] != 'chains':
+                ferams[(parts[0] if len(parts) == 2 else '', parts[-1])] = tar.extractfile(member).read().decode()
+            elif parts == ('thermo.avg',):
+                avg = tar.extractfile(member).read()
+            elif len(parts) == 2 and parts[0] == 'coords':
+                coords.append(parts[1])
+
+    names = sorted(name for name in parquets if not is_stats(name))
+    if not names:
+        return None
+
+    sim_name = Path(names[0]).stem
+    return RunFiles(
+        sim_name = sim_name,
+        ferams   = {stage: text for (stage, name), text in ferams.items() if name == f'{sim_name}.feram'},
+        avg      = avg,
+        coords   = coords,
+        parquet  = parquets[names[0]],
+        stats    = parquets.get(f'{sim_name}.stats.parquet'),
+    )
+
+
+def avg_kelvins(avg: bytes) -> list[float]:
+    '''First column of thermo.avg; the other columns are not parsed.'''
+    return parse_lines(read_lines(avg), AVG_SCHEMA).select('kelvin').collect()['kelvin'].to_list()
+
+def identify_material(setup: dict[str, str]) -> Optional[str]:
+    def matches(material: Material) -> bool:
+        return all(abs(float(setup[key]) - getattr(material, key)) < 1e-6
+                   for key in ('mass_amu', 'a0', 'Z_star') if key in setup)
+
+    return next((name for name, material in MATERIALS.items() if 'a0' in setup and matches(material)), None)
+
+def run_row(run: str, source: Path, archived: bool, mtime_ns: int, files: RunFiles) -> dict[str, Any]:
+    setups  = {stage: parse_feram_file(text) for stage, text in sorted(files.ferams.items())}
+    stages  = [stage for stage in setups if stage]
+    first   = next(iter(setups.values()), {})
+
+    if files.avg is not None:
+        kelvins = avg_kelvins(files.avg)
+    elif stages:
+        kelvins = [float(setups[stage]['kelvin']) for stage in stages if 'kelvin' in setups[stage]]
+    else:
+        kelvins = sorted(float(Path(name).stem) for name in files.coords)
+
+    def numbers(key: str, kind: type) -> Optional[list]:
+        return [kind(v) for v in first[key].split()] if key in first else None
+
+    return {
+        'run':        run,
+        'source':     str(source),
+        'archived':   archived,
+        'mtime_ns':   mtime_ns,
+        'sim_name':   files.sim_name,
+        'kind':       'ece' if stages else 'temperature',
+        'material':   identify_material(first),
+        'structure':  first.get('bulk_or_film'),
+        'method':     first.get('method'),
+        'L':          numbers('L', int),
+        'E_field':    numbers('external_E_field', float),
+        'stages':     stages,
+        'kelvins':    kelvins,
+        'kelvin_min': min(kelvins, default=None),
+        'kelvin_max': max(kelvins, default=None),
+        'config':     json.dumps(setups),
+        'parquet':    str(files.parquet),
+        'stats':      str(files.stats) if files.stats else None,
+    }
+
+
+class Catalog(NamedTuple):
+    table: pl.DataFrame  # CATALOG_SCHEMA
+
+    def runs(self, predicate: Optional[pl.Expr] = None) -> pl.DataFrame:
+        return self.table if predicate is None else self.table.filter(predicate)
+
+    def scan(self, predicate: Optional[pl.Expr] = None, table: str = 'parquet', metadata: Sequence[str] = ('run',)) -> pl.LazyFrame:
+        '''Union of table ('parquet' or 'stats') of the runs matching predicate, columns missing in a run are null.
+        metadata: catalog columns added to every row. Filters on the result are pushed down into every file.'''
+        def readable(row: dict[str, Any]) -> str:
+            # extracted again if evicted from the cache meanwhile, e.g. by the catalog of another root
+            path = Path(row[table])
+            if row['archived'] and not path.is_file():
+                archive_files(Path(row['source']), path.parent)
+            return row[table]
+
+        columns = dict.fromkeys([table, 'source', 'archived', *metadata])
+        rows    = self.runs(predicate).filter(pl.col(table).is_not_null()).select(*columns).iter_rows(named=True)
+        scans   = [
+            pl.scan_parquet(readable(row)).with_columns(pl.lit(row[name], dtype=CATALOG_SCHEMA[name]).alias(name) for name in metadata)
+            for row in rows
+        ]
+        return pl.concat(scans, how='diagonal_relaxed') if scans else pl.LazyFrame(schema={name: CATALOG_SCHEMA[name] for name in metadata})
+
+
+def index_path() -> Path:
+    return cache_root() / 'catalog.parquet'
+
+def load_catalog(index: Optional[Path] = None) -> Catalog:
+    index = index or index_path()
+    return Catalog(pl.read_parquet(index) if index.is_file() else pl.DataFrame(schema=CATALOG_SCHEMA))
+
+def sources(root: Path, archives: bool) -> Iterator[tuple[str, Path, bool, int]]:
+    '''(run, source, archived, mtime_ns) of every run under root.'''
+    for path in sorted(root.iterdir()):
+        if path.is_dir():
+            parquets = [p for p in (path / '_artifacts').glob('*.parquet') if not is_stats(p)]
+            if parquets:
+                yield path.name, path, False, max(p.stat().st_mtime_ns for p in parquets)
+        elif archives and path.name.endswith('.tar.gz'):
+            yield path.name.removesuffix('.tar.gz'), path, True, path.stat().st_mtime_ns
+
+def build_catalog(root: Optional[Path] = None, archives: bool = False, index: Optional[Path] = None,
+                  policy: Policy = Policy()) -> Catalog:
+    '''Index the runs under root (default: project_root()/output), reusing the rows of runs that didn't change.
+    archives: also index .tar.gz archives, whose parquet files are extracted to the cache ("catalog");
+              the files of the indexed runs are never evicted by policy.'''
+    root        = root or project_root() / 'output'
+    index       = index or index_path()
+    known       = {(row['source'], row['mtime_ns']): row for row in load_catalog(index).table.iter_rows(named=True)}
+    extract_dir = cache_dir('catalog')
+    rows        = []
+
+    for run, source, archived, mtime_ns in sources(root, archives) if root.is_dir() else []:
+        row = known.get((str(source), mtime_ns))
+        if row is None or not Path(row['parquet']).is_file():
+            try:
+                files = archive_files(source, extract_dir) if archived else dir_files(source)
+            except (tarfile.TarError, EOFError, OSError, zlib.error) as e:
+                # an unreadable archive (truncated, still being written, ...) is left out, not the whole catalog
+                print_result(Err(f'build_catalog: {source} skipped: {e}'))
+                files = None
+            row   = run_row(run, source, archived, mtime_ns, files) if files else None
+        if row:
+            rows.append(row)
+
+    table = pl.DataFrame(rows, schema=CATALOG_SCHEMA)
+    tmp   = index.with_name(f'{index.name}.tmp')
+    index.parent.mkdir(parents=True, exist_ok=True)
+    table.write_parquet(tmp)
+    tmp.replace(index)
+
+    # the extracted files of the indexed runs stay
+    evict(extract_dir, policy, keep={Path(path) for row in rows for path in (row['parquet'], row['stats']) if path})
+    return Catalog(table)
+
+
+if __name__ == "__main__":
+    root    = Path(sys.argv[1]) if len(sys.argv) > 1 else None
+    catalog = build_catalog(root, archives=True)
+
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, fmt_str_lengths=40):
+        print(catalog.table.drop('config', 'source', 'parquet', 'stats'))
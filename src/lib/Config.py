@@ -2,6 +2,7 @@ from functools import reduce
 from dataclasses import dataclass, asdict
 from enum import StrEnum
 from collections.abc import Iterable, Iterator
+from pathlib import Path
 from typing import Any, NamedTuple, TypeAlias
 import random
 
@@ -209,3 +210,12 @@ class FeramConfig:
             Z_star = self.material.Z_star,
             factor = 1.6 * 10**3 * self.material.Z_star / self.material.a0**3   # factor: from displacement to polarization; physical meaning: effective charge
         )
+
+
+def parse_feram_file(text: str) -> dict[str, str]:
+    '''key = value pairs of a .feram file (as written by FeramConfig.generate_feram_file), values unparsed.'''
+    pairs = (line.split('=', 1) for line in text.splitlines() if '=' in line and not line.lstrip().startswith('#'))
+    return {k.strip(): v.strip() for k, v in pairs}
+
+def read_feram_file(path: Path) -> dict[str, str]:
+    return parse_feram_file(path.read_text())
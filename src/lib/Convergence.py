@@ -0,0 +1,149 @@
+'''
+Detect when a feram run has equilibrated, from its JSON log.
+
+The most recent `window` records of every observable are split into `n_blocks` blocks.
+An observable is converged when the spread (max - min) of its block means is within its tolerance,
+i.e. there is no drift across the window beyond what the user accepts.
+'''
+
+import json
+import numpy as np
+import polars as pl
+from pathlib import Path
+from collections.abc import Callable, Iterable, Mapping
+from types import MappingProxyType
+from typing import Any, NamedTuple, Optional
+
+from result import Ok
+
+from src.lib.common import BoltzmannConst
+from src.lib.Log import JsonLogTail
+from src.lib.Util import print_result
+
+
+# observables that are not columns of the JSON log
+DERIVED: Mapping[str, pl.Expr] = MappingProxyType({
+    'kelvin': pl.col('dipo_kinetic') / (1.5 * BoltzmannConst),
+    'u_norm': pl.col('u').list.eval(pl.element() ** 2).list.sum().sqrt(),
+})
+
+
+class Criteria(NamedTuple):
+    tolerances: Mapping[str, float] = MappingProxyType({  # observable: largest accepted spread of block means
+        'total_energy': 1e-4,  # [eV]
+        'kelvin':       2.0,   # [K]
+    })
+    window: int   = 10000  # number of most recent records tested
+    n_blocks: int = 5
+    min_step: int = 0      # don't test before this time step
+
+
+class BlockStats(NamedTuple):
+    mean: float
+    sem: float     # standard error of the mean, from the block means
+    spread: float  # max - min of the block means
+
+
+class ConvergenceReport(NamedTuple):
+    converged: bool
+    time_step: Optional[int]  # time step at which the test passed
+    since: Optional[int]      # first time step of the tested window
+    observables: dict[str, Optional[BlockStats]]  # None: observable not in the log
+
+    def to_json(self) -> str:
+        return json.dumps({
+            **self._asdict(),
+            'observables': {k: v._asdict() if v else None for k, v in self.observables.items()}
+        }, indent=2)
+
+
+def observables(df: pl.DataFrame, names: Iterable[str]) -> pl.DataFrame:
+    def column(name: str) -> pl.Expr:
+        return (DERIVED[name] if name in DERIVED else pl.col(name)).cast(pl.Float64).alias(name)
+
+    available = [name for name in names
+                 if all(c in df.columns for c in (DERIVED[name].meta.root_names() if name in DERIVED else [name]))]
+
+    return df.select(pl.col('time_step'), *map(column, available))
+
+def block_stats(values: np.ndarray, n_blocks: int) -> BlockStats:
+    means = np.array([block.mean() for block in np.array_split(values, n_blocks)])
+
+    return BlockStats(
+        mean   = float(values.mean()),
+        sem    = float(means.std(ddof=1) / np.sqrt(n_blocks)),
+        spread = float(means.max() - means.min()),
+    )
+
+def check_window(df: pl.DataFrame, criteria: Criteria) -> ConvergenceReport:
+    '''Test the last criteria.window records of df (a JSON log frame).'''
+    window = observables(df, criteria.tolerances.keys()).tail(criteria.window)
+    steps  = window['time_step']
+
+    if len(window) < criteria.window or steps[-1] < criteria.min_step:
+        return ConvergenceReport(False, None, None, {})
+
+    stats = {
+        name: block_stats(window[name].drop_nulls().to_numpy(), criteria.n_blocks)
+              if name in window.columns and window[name].null_count() <= len(window) - criteria.n_blocks else None
+        for name in criteria.tolerances
+    }
+    converged = all(s is not None and s.spread <= criteria.tolerances[name] for name, s in stats.items())
+
+    return ConvergenceReport(converged, steps[-1] if converged else None, steps[0] if converged else None, stats)
+
+def detect_convergence(df: pl.DataFrame, criteria: Criteria = Criteria(), stride: Optional[int] = None) -> ConvergenceReport:
+    '''Find the first time step of a finished run (a JSON log frame) at which the test passes,
+    testing every stride records (default: one block).'''
+    stride = stride or criteria.window // criteria.n_blocks
+    report = ConvergenceReport(False, None, None, {})
+
+    for end in range(criteria.window, len(df) + 1, stride):
+        report = check_window(df[:end], criteria)
+        if report.converged:
+            break
+
+    return report
+
+
+class ConvergenceMonitor:
+    '''Pass to Feram(..., on_json_log=ConvergenceMonitor(...)) to test the run while it is going.
+
+    stop:         stop feram once converged. Feram then returns an Err, as the output feram only writes
+                  at the end of the run (.avg, .dipoRavg, the last .coord) is missing; the report and the JSON log are kept.
+    on_converged: called once with the report, e.g. to signal the next stage
+    report_file:  the report is written there when the run converges'''
+    def __init__(self,
+                 criteria: Criteria = Criteria(),
+                 stop: bool = False,
+                 on_converged: Optional[Callable[[ConvergenceReport], Any]] = None,
+                 report_file: Optional[Path] = None):
+        self.criteria     = criteria
+        self.stop         = stop
+        self.on_converged = on_converged
+        self.report_file  = report_file
+        self.window       = pl.DataFrame()
+        self.report       = ConvergenceReport(False, None, None, {})
+
+    def __call__(self, rows: pl.DataFrame) -> bool:
+        '''Returns True to ask for feram to be stopped.'''
+        if self.report.converged:
+            return self.stop
+
+        self.window = pl.concat([self.window, rows], how='diagonal_relaxed').tail(self.criteria.window)
+        self.report = check_window(self.window, self.criteria)
+
+        if self.report.converged:
+            print_result(Ok(f'Converged at time step {self.report.time_step} (since {self.report.since})'),
+                         color_ok='cyan', color_body='cyan', text_ok='Converged')
+            if self.report_file:
+                self.report_file.write_text(self.report.to_json())
+            if self.on_converged:
+                self.on_converged(self.report)
+
+        return self.report.converged and self.stop
+
+
+def json_log_convergence(json_path: Path, criteria: Criteria = Criteria()) -> ConvergenceReport:
+    '''detect_convergence on the JSON log of a finished or stopped run.'''
+    return detect_convergence(JsonLogTail(json_path, skip_existing=False).poll(), criteria)
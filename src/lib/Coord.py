@@ -0,0 +1,123 @@
+'''
+Read feram lattice frames: .coord, .dipoRavg (and .restart, which has the .coord layout).
+
+Every line is a lattice site: x y z, then per-site columns. Only the requested columns are parsed.
+
+load_frame parses the requested columns of a frame once, to a binary snapshot in the cache ("frames"),
+and memory-maps it after that.
+'''
+
+import hashlib
+import os
+import threading
+import numpy as np
+import pandas as pd
+import polars as pl
+from pathlib import Path
+from collections.abc import Mapping, Sequence
+from typing import NamedTuple, Optional
+from numpy.typing import NDArray
+
+from src.lib.Cache import Policy, cache_dir, evict_if_full, touch
+from src.lib.common import Int3
+
+
+COORD_COLUMNS = ('ux', 'uy', 'uz',
+                 'dipoPx', 'dipoPy', 'dipoPz',
+                 'dVddix', 'dVddiy', 'dVddiz',
+                 'acouRx', 'acouRy', 'acouRz',
+                 'acouPx', 'acouPy', 'acouPz')
+DIPO_COLUMNS  = COORD_COLUMNS[:3]  # all there is in .dipoRavg
+
+
+class Frame(NamedTuple):
+    '''Sites in file order; columns[name][i] is the value at (x[i], y[i], z[i]).'''
+    x: NDArray[np.int64]
+    y: NDArray[np.int64]
+    z: NDArray[np.int64]
+    columns: Mapping[str, NDArray[np.float64]]
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    @property
+    def size(self) -> Int3:
+        return Int3(*(int(c.max()) + 1 for c in (self.x, self.y, self.z)))
+
+    def grid(self, name: str) -> NDArray[np.float64]:
+        '''Column name on the lattice, indexed [z, y, x] (the layout of vorticity3d).'''
+        Lx, Ly, Lz = self.size
+        grid       = np.full((Lz, Ly, Lx), np.nan)
+        grid[self.z, self.y, self.x] = self.columns[name]
+        return grid
+
+    def grids(self, names: Optional[Sequence[str]] = None) -> NDArray[np.float64]:
+        '''Columns names (default: all) on the lattice, indexed [z, y, x, column].'''
+        names      = list(self.columns) if names is None else names
+        Lx, Ly, Lz = self.size
+        grids      = np.full((Lz, Ly, Lx, len(names)), np.nan)
+        grids[self.z, self.y, self.x] = np.column_stack([self.columns[name] for name in names])
+        return grids
+
+    def to_numpy(self) -> NDArray[np.float64]:
+        return np.column_stack([self.x, self.y, self.z, *self.columns.values()])
+
+    def to_pandas(self) -> pd.DataFrame:
+        return pd.DataFrame({'x': self.x, 'y': self.y, 'z': self.z, **self.columns})
+
+    def to_polars(self) -> pl.DataFrame:
+        return pl.DataFrame({'x': self.x, 'y': self.y, 'z': self.z, **self.columns})
+
+
+def read_frame(path: Path, columns: Sequence[str] = DIPO_COLUMNS, all_columns: Sequence[str] = COORD_COLUMNS) -> Frame:
+    '''columns: which of all_columns (the columns after x y z, in file order) to parse.'''
+    indices = [3 + all_columns.index(name) for name in columns]
+    table   = np.loadtxt(path, dtype=np.float64, usecols=[0, 1, 2, *indices], ndmin=2)
+
+    return Frame(
+        x       = table[:, 0].astype(np.int64),
+        y       = table[:, 1].astype(np.int64),
+        z       = table[:, 2].astype(np.int64),
+        columns = {name: np.ascontiguousarray(table[:, 3 + i]) for i, name in enumerate(columns)}
+    )
+
+
+def snapshot_path(path: Path, usecols: Optional[Sequence[int]]) -> Path:
+    '''Cache file of the snapshot of the columns usecols (None: all) of path; changes whenever path is modified.'''
+    stat = path.stat()
+    cols = 'all' if usecols is None else ','.join(map(str, usecols))
+    key  = hashlib.sha256(f'{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}:{cols}'.encode()).hexdigest()[:32]
+    return cache_dir('frames') / f'{key}.npy'
+
+def write_snapshot(path: Path, snapshot: Path, usecols: Optional[Sequence[int]], policy: Policy) -> NDArray[np.float64]:
+    # (columns, sites): every column is contiguous in the memory map
+    table = np.ascontiguousarray(np.loadtxt(path, dtype=np.float64, usecols=usecols, ndmin=2).T)
+    tmp   = snapshot.with_name(f'{snapshot.stem}.{os.getpid()}.{threading.get_ident()}.tmp.npy')  # concurrent writers of the same frame
+    np.save(tmp, table)
+    tmp.replace(snapshot)
+
+    mapped = np.load(snapshot, mmap_mode='r')  # stays valid if evicted
+    evict_if_full(snapshot.parent, snapshot.stat().st_size, policy)
+    return mapped
+
+def load_frame(path: Path, columns: Optional[Sequence[str]] = DIPO_COLUMNS, all_columns: Sequence[str] = COORD_COLUMNS,
+               policy: Policy = Policy()) -> Frame:
+    '''Like read_frame, from the cached snapshot of path: columns are read-only views of a memory map.
+    columns None: all columns in the file. Every set of columns has its own snapshot.'''
+    usecols  = None if columns is None else [0, 1, 2, *(3 + all_columns.index(name) for name in columns)]
+    snapshot = snapshot_path(path, usecols)
+
+    try:
+        table = np.load(snapshot, mmap_mode='r')
+        touch(snapshot)
+    except FileNotFoundError:
+        table = write_snapshot(path, snapshot, usecols, policy)
+
+    names = all_columns[:len(table) - 3] if columns is None else columns
+
+    return Frame(
+        x       = table[0].astype(np.int64),
+        y       = table[1].astype(np.int64),
+        z       = table[2].astype(np.int64),
+        columns = {name: table[3 + i] for i, name in enumerate(names)}
+    )
@@ -10,11 +10,14 @@ from pathlib import Path
 from dataclasses import dataclass
 from collections import Counter
 from typing import NamedTuple, TypeAlias, Iterator, Optional
-from itertools import accumulate
+from itertools import accumulate, chain
+from numpy.typing import NDArray
 
 from src.lib.common import Int3, Vec3
-from src.lib.Operations import Write, FileOut
-from src.lib.Util import project_root, inclusive_range
+from src.lib.Config import Structure
+from src.lib.Operations import FileOut, WriteTable
+from src.lib.Text import Table, int_column
+from src.lib.Util import content_key, inclusive_range, project_root
 
 
 Props: TypeAlias = Vec3[float]
@@ -113,19 +116,126 @@ def generate_coords(size: Int3) -> list[Int3]:
     ]
 
 
-def find_boundaries(size: Int3, domains: Sequence[Domain]) -> PointMap:
-    coords: list[Int3] = generate_coords(size)
-    system: System = System(
-        size,
-        {coord: PointProps(find_closest_domain(domains, coord), None) for coord in coords},
+def unique_domains(domains: Sequence[Domain]) -> tuple[list[Domain], NDArray[np.intp]]:
+    '''Equal domains are counted as one, as in System.find_boundary.
+    Returns the distinct domains (first occurrences) and the index of every domain into them.'''
+    first = {}
+    index = np.array([first.setdefault(domain, len(first)) for domain in domains], dtype=np.intp)
+    return list(first), index
+
+Periodic: TypeAlias = Vec3[bool]  # periodic boundary condition along x, y, z
+
+OPEN = Periodic(False, False, False)
+
+def periodic_axes(structure: Structure) -> Periodic:
+    '''Boundary conditions implied by General.bulk_or_film: bulk is periodic, films are open along z.'''
+    match structure:
+        case Structure.Film | Structure.Epit_001 | Structure.Epit_110:
+            return Periodic(True, True, False)
+        case _:
+            return Periodic(True, True, True)
+
+
+def sphere_offsets(radius: float) -> list[Int3]:
+    '''Neighbor offsets within radius (in lattice units), nearest first.
+    Within a shell, the order is -x, -y, -z, +x, +y, +z as in System.find_neighbors,
+    generalized as: offsets pointing "down" (first nonzero component negative) first, mirrored pairs in the same order.'''
+    r  = int(radius)
+    r2 = radius**2 + 1e-9
+
+    def order(offset: Int3) -> tuple:
+        down = next(c for c in offset if c != 0) < 0
+        return (sum(c**2 for c in offset), not down, offset if down else tuple(-c for c in offset))
+
+    return sorted(
+        (Int3(x, y, z)
+         for x in range(-r, r + 1)
+         for y in range(-r, r + 1)
+         for z in range(-r, r + 1)
+         if 0 < x**2 + y**2 + z**2 <= r2),
+        key=order
     )
 
-    boundaries = {
-        coord: PointProps(*system.find_boundary(coord, 1)) for coord in system.points.keys()
+SHELLS = {6: 1.0, 18: np.sqrt(2), 26: np.sqrt(3)}  # number of neighbors: radius
+
+def shell_offsets(n: int) -> list[Int3]:
+    '''The 6 nearest, 18 (up to second nearest) or 26 (up to third nearest) neighbors.'''
+    return sphere_offsets(SHELLS[n])
+
+
+def closest_labels(size: Int3, seeds: Sequence[Int3], periodic: Periodic = OPEN) -> NDArray[np.intp]:
+    '''Index of the closest seed of every point of the (x, y, z) lattice; the first seed wins ties, as in find_closest_domain.
+    Along periodic axes the distance is that to the closest periodic image of the seed.'''
+    axes     = np.ogrid[:size[0], :size[1], :size[2]]
+    labels   = np.zeros(tuple(size), dtype=np.intp)
+    shortest = np.full(tuple(size), np.iinfo(np.int64).max, dtype=np.int64)
+
+    def axis_distance(axis: int, s: int) -> NDArray:
+        delta = np.abs(axes[axis] - s)
+        if periodic[axis]:
+            delta = np.minimum(delta % size[axis], size[axis] - delta % size[axis])
+        return delta**2
+
+    for i, seed in enumerate(seeds):
+        distance = sum(axis_distance(axis, s) for axis, s in enumerate(seed))  # squared, exact in integers
+        closer   = distance < shortest
+        labels[closer]   = i
+        shortest[closer] = distance[closer]
+
+    return labels
+
+def neighbor_labels(labels: NDArray, offset: Int3, periodic: Periodic) -> tuple[NDArray, NDArray[np.bool_]]:
+    '''labels of the neighbor at offset of every point, and where that neighbor exists (always, along periodic axes).'''
+    neighbor = np.roll(labels, tuple(-o for o in offset), axis=(0, 1, 2))
+    valid    = np.ones(labels.shape, dtype=bool)
+
+    for axis, (o, n) in enumerate(zip(offset, labels.shape)):
+        if o != 0 and not periodic[axis]:
+            inside = (np.arange(n) + o >= 0) & (np.arange(n) + o < n)
+            valid &= inside.reshape([n if a == axis else 1 for a in range(3)])
+
+    return neighbor, valid
+
+def majority_labels(labels: NDArray[np.intp], offsets: Sequence[Int3] = shell_offsets(6),
+                    periodic: Periodic = OPEN) -> tuple[NDArray[np.intp], NDArray[np.float64]]:
+    '''Vectorized System.find_boundary for every point: the label most common among the neighbors at offsets
+    and its fraction of them. Ties go to the label seen first in the order of offsets.
+    Costs O((len(offsets) + number of labels) * L^3).'''
+    n_labels = int(labels.max()) + 1
+    n_points = labels.size
+    points   = np.arange(n_points)
+    counts   = np.zeros((n_labels, n_points), dtype=np.int32)
+    first    = np.full((n_labels, n_points), len(offsets), dtype=np.int32)  # first offset showing the label
+    n_valid  = np.zeros(n_points, dtype=np.int32)
+
+    for k, offset in enumerate(offsets):
+        neighbor, valid = neighbor_labels(labels, offset, periodic)
+        label, point    = neighbor.ravel()[valid.ravel()], points[valid.ravel()]
+        counts[label, point] += 1
+        first[label, point]   = np.minimum(first[label, point], k)
+        n_valid[point]       += 1
+
+    # most neighbors first, then first seen
+    majority = np.argmax(counts.astype(np.int64) * (len(offsets) + 1) - first, axis=0)
+    count    = counts[majority, points]
+
+    return majority.reshape(labels.shape), (count / n_valid).reshape(labels.shape)
+
+
+def find_boundaries(size: Int3, domains: Sequence[Domain],
+                    offsets: Sequence[Int3] = shell_offsets(6), periodic: Periodic = OPEN) -> PointMap:
+    '''Assign every point to its closest domain, then report for every point the domain most common among its neighbors
+    and its fraction of them (< 1: the point is on a domain boundary).
+    The defaults reproduce System.find_boundary: 6 nearest neighbors, open boundaries.'''
+    distinct, index    = unique_domains(domains)
+    labels             = index[closest_labels(size, [domain.seed for domain in domains], periodic)]
+    majority, boundary = majority_labels(labels, offsets, periodic)
+
+    return {
+        coord: PointProps(distinct[label], fraction)
+        for coord, label, fraction in zip(generate_coords(size), majority.ravel().tolist(), boundary.ravel().tolist())
     }
 
-    return boundaries
-
 
 def generate_localfield(system: PointMap) -> Iterator[str]:
     # return '\n'.join(f'{x} {y} {z} {point.domain.props[0]} {point.domain.props[1]} {point.domain.props[2]}'
@@ -137,9 +247,44 @@ def generate_localfield(system: PointMap) -> Iterator[str]:
         px, py, pz = point.domain.props
         yield f'{x} {y} {z} {px} {py} {pz}'
 
-def LocalfieldWriter(output_path: Path, size: Int3, domains: Sequence[Domain]):
-    return Write(FileOut(output_path),
-                 lambda: '\n'.join(generate_localfield(find_boundaries(size, domains))))
+def boundary_table(size: Int3, domains: Sequence[Domain], offsets: Sequence[Int3], periodic: Periodic,
+                   defects: bool) -> Table:
+    '''Array version of generate_localfield(find_boundaries(...)), or of generate_defects if defects.'''
+    distinct, index    = unique_domains(domains)
+    labels             = index[closest_labels(size, [domain.seed for domain in domains], periodic)]
+    majority, boundary = majority_labels(labels, offsets, periodic)
+    props              = np.array([domain.props for domain in distinct], dtype=np.float64)
+    x, y, z            = (c.ravel() for c in np.indices(tuple(size)))
+    label              = majority.ravel()
+
+    if defects:
+        on_boundary    = ((boundary > 0) & (boundary < 1)).ravel()
+        x, y, z, label = x[on_boundary], y[on_boundary], z[on_boundary], label[on_boundary]
+        props[:, 0]   *= 134.106
+        props_strings  = [f'{px * 134.106} {py} {pz}' for px, py, pz in (d.props for d in distinct)]
+    else:
+        props_strings  = [f'{px} {py} {pz}' for px, py, pz in (d.props for d in distinct)]
+
+    return Table(
+        columns = [int_column(x), int_column(y), int_column(z),
+                   (label, props_strings)],
+        array   = lattice_array(x, y, z, props[label], ('px', 'py', 'pz'))
+    )
+
+def lattice_array(x: NDArray, y: NDArray, z: NDArray, values: NDArray, names: Sequence[str]) -> NDArray:
+    '''Rows of an input file as a structured array: x, y, z, *names.'''
+    array = np.empty(len(x), dtype=[('x', np.int64), ('y', np.int64), ('z', np.int64),
+                                    *((name, values.dtype) for name in names)])
+    array['x'], array['y'], array['z'] = x, y, z
+    for i, name in enumerate(names):
+        array[name] = values[:, i] if values.ndim > 1 else values
+    return array
+
+def LocalfieldWriter(output_path: Path, size: Int3, domains: Sequence[Domain],
+                     offsets: Sequence[Int3] = shell_offsets(6), periodic: Periodic = OPEN):
+    return WriteTable(FileOut(output_path),
+                      lambda: boundary_table(size, domains, offsets, periodic, defects=False),
+                      content_key('localfield', size, domains, offsets, periodic))
 
 
 def generate_defects(system: PointMap) -> Iterator[str]:
@@ -150,6 +295,12 @@ def generate_defects(system: PointMap) -> Iterator[str]:
         if point.boundary and point.boundary < 1:
             yield f'{x} {y} {z} {px * 134.106} {py} {pz}' # 134.106?
 
+def DefectsWriter(output_path: Path, size: Int3, domains: Sequence[Domain],
+                  offsets: Sequence[Int3] = shell_offsets(6), periodic: Periodic = OPEN):
+    return WriteTable(FileOut(output_path),
+                      lambda: boundary_table(size, domains, offsets, periodic, defects=True),
+                      content_key('defects', size, domains, offsets, periodic))
+
 
 def assign_modulation(z: int, bto_sto: tuple[int, int]) -> int:
     bto_sto_acc = list(accumulate(bto_sto, op.add))
@@ -164,12 +315,29 @@ def generate_modulation(coords: list[Int3], bto_sto: tuple[int, int]) -> Iterato
     return (f'{x} {y} {z} {assign_modulation(z, bto_sto)}'
         for x, y, z in coords)
 
+def modulation_table(coords: NDArray[np.int64], bto_sto: tuple[int, int]) -> Table:
+    '''Array version of generate_modulation; coords: (n, 3).'''
+    bto, period = list(accumulate(bto_sto, op.add))
+    x, y, z     = coords.T
+    is_sto      = (z % period >= bto).astype(np.intp)
+
+    return Table(
+        columns = [int_column(x), int_column(y), int_column(z), (is_sto, ['8', '-8'])],
+        array   = lattice_array(x, y, z, np.where(is_sto, -8, 8), ('modulation',))
+    )
+
 def ModulationWriter(output_path: Path, coords: list[Int3], bto_sto: tuple[int, int]):
-    return Write(FileOut(output_path),
-                 lambda: '\n'.join(generate_modulation(coords, bto_sto)))
+    coords_array = np.fromiter(chain.from_iterable(coords), dtype=np.int64, count=3 * len(coords)).reshape(-1, 3)
+    return WriteTable(FileOut(output_path),
+                      lambda: modulation_table(coords_array, bto_sto),
+                      content_key('modulation', coords_array, bto_sto))
 
 
-def generate_regional_localfield(domains: Sequence[Domain]):
+def generate_regional_localfield(domains: Sequence[Domain], size: Optional[Int3] = None, periodic: Periodic = OPEN):
+    '''Along periodic axes, regions crossing the box (of size) continue on the other side.'''
+    def wrap(value: int, axis: int) -> int:
+        return value % size[axis] if size is not None and periodic[axis] else value
+
     for domain in domains:
         '''generate_regional_localfield((10,10,10), (-2,2,0)) will find the region where x=(10, 10-2), y=(10, 10+2), z=(10,10+0)'''
         x1, y1, z1 = np.array(domain.seed)
@@ -178,11 +346,32 @@ def generate_regional_localfield(domains: Sequence[Domain]):
         for x in inclusive_range(x1, x2):
             for y in inclusive_range(y1, y2):
                 for z in inclusive_range(z1, z2):
-                    yield f'{x} {y} {z} {px} {py} {pz}'
+                    yield f'{wrap(x, 0)} {wrap(y, 1)} {wrap(z, 2)} {px} {py} {pz}'
+
+def regional_localfield_table(domains: Sequence[Domain], size: Optional[Int3] = None, periodic: Periodic = OPEN) -> Table:
+    '''Array version of generate_regional_localfield.
+    Along periodic axes, regions crossing the box (of size) continue on the other side.'''
+    def region(domain: Domain) -> NDArray[np.int64]:
+        start, end = np.array(domain.seed), np.array(domain.seed) + np.array(domain.delta)
+        axes       = [np.arange(min(a, b), max(a, b) + 1) for a, b in zip(start, end)]
+        points     = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+        return np.where(periodic, points % np.array(size), points) if size is not None else points
+
+    regions = [region(domain) for domain in domains]
+    x, y, z = np.concatenate(regions).T if regions else np.empty((3, 0), dtype=np.int64)
+    label   = np.repeat(np.arange(len(domains)), [len(r) for r in regions])
+    props   = np.array([domain.props for domain in domains], dtype=np.float64).reshape(-1, 3)
+
+    return Table(
+        columns = [int_column(x), int_column(y), int_column(z),
+                   (label, [f'{px} {py} {pz}' for px, py, pz in (d.props for d in domains)])],
+        array   = lattice_array(x, y, z, props[label], ('px', 'py', 'pz'))
+    )
 
-def RegionalLocalfieldWriter(output_path: Path, domains: Sequence[Domain]):
-    return Write(FileOut(output_path),
-                 lambda: '\n'.join(generate_regional_localfield(domains)))
+def RegionalLocalfieldWriter(output_path: Path, domains: Sequence[Domain], size: Optional[Int3] = None, periodic: Periodic = OPEN):
+    return WriteTable(FileOut(output_path),
+                      lambda: regional_localfield_table(domains, size, periodic),
+                      content_key('regional_localfield', domains, size, periodic))
  
 # if __name__ == '__main__':
 #     pass
@@ -0,0 +1,236 @@
+'''
+Journal of the completed steps of a run (e.g. the temperatures of a sweep), so that an interrupted run can be resumed.
+
+{run directory}/journal.jsonl has a line per completed step: the sha256 of its outputs and of the restart file
+it started from, and the sizes of the files it appended to. A resumed run skips the leading steps that are
+recorded, whose outputs are unchanged and each of which restarted from the output of the step before;
+it then rewinds the state to the last of them and runs the rest.
+
+The state before the first step is recorded too (START), with a copy of its restart file (journal.restart),
+so that a run interrupted during the first step is rewound to where it began.
+'''
+
+import json
+import shutil
+import threading
+from pathlib import Path
+from collections.abc import Sequence
+from typing import NamedTuple, Optional
+
+from src.lib.Capability import sha256
+from src.lib.Operations import *
+
+
+JOURNAL_FILE = 'journal.jsonl'
+START_FILE   = 'journal.restart'  # the restart file of the first step, before it ran
+START        = '<start>'          # name of the record of the state before the first step
+
+
+class Step(NamedTuple):
+    name: str
+    operation: Operation
+    outputs: Sequence[Path]         # outputs[0]: what the next step restarts from
+    restart: Optional[Path] = None  # restart file the step reads, a copy of outputs[0] of the step before
+    appends: Sequence[Path] = ()    # files the step appends to, e.g. thermo.avg
+
+class Record(NamedTuple):
+    name: str
+    outputs: dict[str, Optional[str]]  # path relative to the run directory -> sha256
+    restart: Optional[str]             # sha256 of the restart file the step started from
+    sizes: dict[str, int]              # of the appended files, after the step
+
+
+class Journal:
+    '''Empty until opened, see OpenJournal.'''
+    def __init__(self, directory: Path):
+        self.directory  = directory
+        self.path       = directory / JOURNAL_FILE
+        self.start_file = directory / START_FILE
+        self.lock       = threading.Lock()  # steps may complete concurrently
+        self.records: dict[str, Record] = {}
+
+    def open(self, resume: bool) -> None:
+        '''resume: continue the journal in directory, otherwise start a new one.'''
+        if resume:
+            self.records = self.load()
+        else:
+            self.records = {}
+            self.path.unlink(missing_ok=True)
+            self.start_file.unlink(missing_ok=True)
+
+    def load(self) -> dict[str, Record]:
+        if not self.path.is_file():
+            return {}
+
+        records = {}
+        for line in self.path.read_text().splitlines():
+            try:
+                record = Record(**json.loads(line))
+            except (ValueError, TypeError):
+                continue  # torn last line of an interrupted run
+            records[record.name] = record
+        return records
+
+    def relative(self, path: Path) -> str:
+        return str(path.relative_to(self.directory))
+
+    def digest(self, path: Optional[Path]) -> Optional[str]:
+        return sha256(path) if path is not None and path.is_file() else None
+
+    def write(self, record: Record) -> Record:
+        with self.lock:
+            with self.path.open('a') as f:
+                f.write(json.dumps(record._asdict()) + '\n')
+            self.records[record.name] = record
+        return record
+
+    def record(self, step: Step, restart: Optional[str]) -> Record:
+        return self.write(Record(
+            name    = step.name,
+            outputs = {self.relative(path): self.digest(path) for path in step.outputs},
+            restart = restart,
+            sizes   = {self.relative(path): path.stat().st_size for path in step.appends if path.is_file()},
+        ))
+
+    def record_start(self, first: Step) -> Record:
+        '''Record the state before the first step: its restart file (kept as start_file) and the sizes of its appended files.'''
+        if first.restart is not None and first.restart.is_file():
+            shutil.copy2(first.restart, self.start_file)
+        else:
+            self.start_file.unlink(missing_ok=True)
+
+        return self.write(Record(
+            name    = START,
+            outputs = {},
+            restart = self.digest(first.restart),
+            sizes   = {self.relative(path): path.stat().st_size for path in first.appends if path.is_file()},
+        ))
+
+    def restore_start(self, first: Step) -> None:
+        '''Put back the restart file of the first step as recorded by record_start, or remove it if there was none.'''
+        if first.restart is None:
+            return
+        if self.records[START].restart is None:
+            first.restart.unlink(missing_ok=True)
+        else:
+            shutil.copy2(self.start_file, first.restart)
+
+    def is_intact(self, step: Step) -> bool:
+        '''step is recorded, and its outputs still exist unchanged.'''
+        record = self.records.get(step.name)
+        if record is None:
+            return False
+
+        digests = [(record.outputs.get(self.relative(path)), self.digest(path)) for path in step.outputs]
+        return all(current is not None and recorded == current for recorded, current in digests)
+
+    def started_from(self, steps: Sequence[Step], i: int) -> Optional[str]:
+        '''sha256 of the restart file steps[i] has to start from: the output of the step before, or the recorded start.'''
+        if i > 0:
+            before = steps[i - 1]
+            return self.records[before.name].outputs[self.relative(before.outputs[0])]
+        start = self.records.get(START)
+        return start.restart if start else None
+
+    def completed(self, steps: Sequence[Step]) -> int:
+        '''Number of leading steps that are done: recorded, outputs unchanged, restarted from the step before
+        (the first one: from the recorded start).'''
+        for i, step in enumerate(steps):
+            if not self.is_intact(step):
+                return i
+            if step.restart is not None and (i == 0 and START not in self.records
+                                             or self.records[step.name].restart != self.started_from(steps, i)):
+                return i
+        return len(steps)
+
+
+class OpenJournal(Operation):
+    '''Journal.open, once the run directory is there: after the preconditions of the run were checked.'''
+    def __init__(self, journal: Journal, resume: bool):
+        super().__init__(lambda: self.do(journal, resume))
+
+    @as_result(Exception)
+    def safe_open(self, journal: Journal, resume: bool) -> int:
+        journal.open(resume)
+        return len(journal.records)
+
+    def do(self, journal: Journal, resume: bool) -> OperationR:
+        return self.safe_open(journal, resume)\
+            .map(lambda n: f'{type(self).__name__}: {journal.path}' + (f' ({n} records)' if resume else ''))\
+            .map_err(lambda x: f'{type(self).__name__}: {x}')
+
+
+class Journaled(Operation):
+    '''Run step.operation, and record step in journal when it succeeds.'''
+    def __init__(self, journal: Journal, step: Step):
+        super().__init__(lambda: self.do(journal, step))
+
+    @as_result(Exception)
+    def safe_digest(self, journal: Journal, path: Optional[Path]) -> Optional[str]:
+        return journal.digest(path)
+
+    @as_result(Exception)
+    def safe_record(self, journal: Journal, step: Step, restart: Optional[str]) -> Record:
+        return journal.record(step, restart)
+
+    def do(self, journal: Journal, step: Step) -> OperationR:
+        return do(
+            Ok(record)
+            for restart in self.safe_digest(journal, step.restart)
+            for _ in step.operation.run()
+            for record in self.safe_record(journal, step, restart)
+        ).map(lambda record: f'{type(self).__name__}: {record.name}').map_err(lambda x: f'{type(self).__name__}: {x}')
+
+
+class Rewind(Operation):
+    '''Put back the state after steps[:n]: appended files truncated to their sizes then,
+    the restart file of steps[n] copied from the output it restarts from (the first step: restored, see Journal.record_start).
+    Records the start if the first step never ran.'''
+    def __init__(self, journal: Journal, steps: Sequence[Step], n: int):
+        super().__init__(lambda: self.do(journal, steps, n))
+
+    @as_result(Exception)
+    def safe_truncate(self, sizes: Sequence[tuple[Path, int]]) -> None:
+        for path, size in sizes:
+            if path.is_file() and path.stat().st_size > size:
+                with path.open('r+b') as f:
+                    f.truncate(size)
+
+    @as_result(Exception)
+    def safe_record_start(self, journal: Journal, first: Step) -> Record:
+        return journal.record_start(first)
+
+    @as_result(Exception)
+    def safe_restore_start(self, journal: Journal, first: Step) -> None:
+        journal.restore_start(first)
+
+    def do(self, journal: Journal, steps: Sequence[Step], n: int) -> OperationR:
+        name = type(self).__name__
+
+        if n == len(steps):
+            return Ok(f'{name}: all {n} steps completed')
+        if n == 0 and START not in journal.records:
+            return self.safe_record_start(journal, steps[0])\
+                .map(lambda _: f'{name}: start from {steps[0].name}').map_err(lambda x: f'{name}: {x}')
+
+        before  = journal.records[steps[n - 1].name if n > 0 else START]
+        sizes   = [(path, before.sizes.get(journal.relative(path), 0)) for path in steps[n].appends]
+        restart = steps[n].restart
+
+        return do(
+            Ok(None)
+            for _ in self.safe_truncate(sizes)
+            for _ in (self.safe_restore_start(journal, steps[0]) if n == 0 else
+                      Copy(FileIn(steps[n - 1].outputs[0]), FileOut(restart)).run() if restart else Ok(None))
+        ).map(lambda _: f'{name}: resume from {steps[n].name}').map_err(lambda x: f'{name}: {x}')
+
+
+def resume_steps(journal: Journal, steps: Sequence[Step]) -> OperationSequence:
+    '''Skip the steps completed according to journal, rewind to the last of them and run (and record) the others.'''
+    n = journal.completed(steps)
+
+    return OperationSequence([
+        *(Message(f'{step.name}: completed') for step in steps[:n]),
+        Rewind(journal, steps, n),
+        *(Journaled(journal, step) for step in steps[n:]),
+    ])
@@ -1,11 +1,19 @@
+import json
+import re
+import sys
+import time
+import numpy as np
 import pandas as pd
 import polars as pl
-from parsy import Parser, seq, any_char, whitespace, string, regex
 from pathlib import Path
-from collections.abc import Sequence
-from typing import NamedTuple, Optional
+from collections.abc import Callable, Iterable, Iterator, Mapping, Sequence
+from dataclasses import dataclass
+from itertools import batched
+from typing import NamedTuple, Optional, overload
+from numpy.typing import NDArray
 
 from src.lib.common import Vec3
+from src.lib.Schema import LOG_SCHEMA
 from src.lib.Util import project_root
 
 
@@ -31,83 +39,284 @@ class TimeStep(NamedTuple):
     p:               Optional[Vec3[float]]
     p_sigma:         Optional[Vec3[float]]
 
-class Log(NamedTuple):
-    time_steps: Sequence[TimeStep]
+FLOAT_FIELDS: list[str] = [
+    'acou_kinetic',
+    'dipo_kinetic',
+    'short_range',
+    'long_range',
+    'dipole_E_field',
+    'unharmonic',
+    'homo_strain',
+    'homo_coupling',
+    'inho_strain',
+    'inho_coupling',
+    'inho_modulation',
+    'total_energy',
+    'H_Nose_Poincare',
+    's_Nose',
+    'pi_Nose',
+]
+
+VECTOR_FIELDS: list[tuple[str, str]] = [
+    ('u',       '<u>'),
+    ('u_sigma', 'sigma'),
+    ('p',       '<p>'),
+    ('p_sigma', 'sigma'),
+]
+
+VEC3_SCHEMA = pl.Struct({'x': pl.Float64, 'y': pl.Float64, 'z': pl.Float64})
+
+TIME_STEP_SCHEMA: dict[str, pl.DataType] = {
+    'time_step': pl.Int64(),
+    **{name: pl.Float64() for name in FLOAT_FIELDS},
+    **{name: VEC3_SCHEMA for name, _ in VECTOR_FIELDS},
+}
+
+
+@dataclass(frozen=True)
+class Log(Sequence[TimeStep]):
+    '''Struct of arrays: time_step is int64, the other scalar fields are float64 and the vector fields
+    are (N, 3) float64 in Fortran order, so that every component is contiguous. Missing values are NaN.
+
+    Rows are materialized as TimeStep only when they are accessed.'''
+    columns: Mapping[str, NDArray]
+
+    @classmethod
+    def from_time_steps(cls, time_steps: Iterable[TimeStep], block_size: int = 1 << 16) -> 'Log':
+        '''Fill the columns block by block, so that at most block_size TimeSteps are alive at a time.'''
+        def vector(v: Optional[Vec3[float]]) -> Sequence[float]:
+            return v if v is not None else (np.nan, np.nan, np.nan)
+
+        def to_block(time_steps: Sequence[TimeStep]) -> dict[str, NDArray]:
+            fields = list(zip(*time_steps))
+            return {
+                'time_step': np.array(fields[0], dtype=np.int64),
+                **{name: np.array(fields[i], dtype=np.float64)
+                   for i, name in enumerate(FLOAT_FIELDS, start=1)},
+                **{name: np.array([vector(v) for v in fields[i]], dtype=np.float64)
+                   for i, (name, _) in enumerate(VECTOR_FIELDS, start=1 + len(FLOAT_FIELDS))},
+            }
+
+        blocks = [to_block(batch) for batch in batched(time_steps, block_size)]
+
+        return cls({
+            'time_step': np.concatenate([b['time_step'] for b in blocks]) if blocks else np.empty(0, np.int64),
+            **{name: np.concatenate([b[name] for b in blocks]) if blocks else np.empty(0)
+               for name in FLOAT_FIELDS},
+            **{name: np.asfortranarray(np.concatenate([b[name] for b in blocks]) if blocks else np.empty((0, 3)))
+               for name, _ in VECTOR_FIELDS},
+        })
+
+    def __post_init__(self) -> None:
+        # views are handed out by to_numpy/to_polars
+        for column in self.columns.values():
+            column.setflags(write=False)
+
+    def __len__(self) -> int:
+        return len(self.columns['time_step'])
+
+    @overload
+    def __getitem__(self, index: int) -> TimeStep: ...
+    @overload
+    def __getitem__(self, index: slice) -> 'Log': ...
+    def __getitem__(self, index: int | slice) -> 'TimeStep | Log':
+        if isinstance(index, slice):
+            return Log({name: column[index] for name, column in self.columns.items()})
+
+        def scalar(v: np.float64) -> Optional[float]:
+            return None if np.isnan(v) else float(v)
+
+        def vector(v: NDArray) -> Optional[Vec3[float]]:
+            return None if np.isnan(v[0]) else Vec3(*map(float, v))
+
+        return TimeStep(
+            int(self.columns['time_step'][index]),
+            *(scalar(self.columns[name][index]) for name in FLOAT_FIELDS),
+            *(vector(self.columns[name][index]) for name, _ in VECTOR_FIELDS)
+        )
+
+    @property
+    def time_steps(self) -> Sequence[TimeStep]:
+        return self
+
+    def to_numpy(self) -> dict[str, NDArray]:
+        '''Read-only views of the columns.'''
+        return dict(self.columns)
 
     def to_pandas(self) -> pd.DataFrame:
-        return pd.DataFrame(self.time_steps)
+        def vectors(column: NDArray) -> list[Optional[Vec3[float]]]:
+            return [None if np.isnan(x) else Vec3(x, y, z) for x, y, z in column.tolist()]
+
+        return pd.DataFrame({
+            'time_step': self.columns['time_step'],
+            **{name: self.columns[name] for name in FLOAT_FIELDS},
+            **{name: vectors(self.columns[name]) for name, _ in VECTOR_FIELDS},
+        })
 
     def to_polars(self) -> pl.DataFrame:
-        return pl.DataFrame(self.time_steps)
+        '''Columns without missing values are zero-copy.'''
+        def series(name: str, column: NDArray) -> pl.Series:
+            return pl.Series(name, column, dtype=pl.Float64, nan_to_null=bool(np.isnan(column).any()))
+
+        def vector(name: str) -> pl.Expr:
+            column = self.columns[name]
+            xyz    = pl.struct(*(series(c, column[:, i]) for i, c in enumerate('xyz')))
+            return pl.when(pl.lit(series('x', column[:, 0])).is_not_null()).then(xyz).alias(name)
+
+        return pl.DataFrame([
+            pl.Series('time_step', self.columns['time_step'], dtype=pl.Int64),
+            *(series(name, self.columns[name]) for name in FLOAT_FIELDS),
+        ]).with_columns(
+            *map(vector, (name for name, _ in VECTOR_FIELDS))
+        ).cast(TIME_STEP_SCHEMA)
+
+
+def time_steps_to_polars(time_steps: Sequence[TimeStep]) -> pl.DataFrame:
+    return pl.DataFrame(time_steps, schema=TIME_STEP_SCHEMA, orient='row')
 
 
 def read_log(log_path: Path) -> str:
     with open(log_path, 'r') as log:
         return log.read()
 
+
+TS_START = 'TIME_STEP'
+TS_END   = 'TIME_STEP_END'
+
+time_step_re = re.compile(r'TIME_STEP\s+(\d+)')
+float_re     = re.compile(r'\s+(\-?\d+\.\d+)')
+vector_re    = re.compile(r'\s+(\-?\d+\.\d+)\s+(\-?\d+\.\d+)\s+(\-?\d+\.\d+)')
+
+def split_sections(chunks: Iterable[str]) -> Iterator[str]:
+    '''Yield every complete 'TIME_STEP ... TIME_STEP_END' section of a log read in chunks.
+    Only the current, unfinished section is kept in memory.'''
+    buffer = ''
+
+    for chunk in chunks:
+        buffer += chunk
+        pos     = 0
+
+        while (start := buffer.find(TS_START, pos)) >= 0 and (end := buffer.find(TS_END, start)) >= 0:
+            pos = end + len(TS_END)
+            yield buffer[start:pos]
+
+        # keep the unfinished section, or the tail in case TS_START is split across chunks
+        start  = buffer.find(TS_START, pos)
+        buffer = buffer[start:] if start >= 0 else buffer[max(pos, len(buffer) - len(TS_START) + 1):]
+
+def parse_section(section: str) -> TimeStep:
+    '''Fields are searched in order, each one after the previous match.'''
+    def find(token: str, pattern: re.Pattern, pos: int) -> tuple[Optional[re.Match], int]:
+        start = section.find(token, pos)
+        match = pattern.match(section, start + len(token)) if start >= 0 else None
+
+        return (match, match.end()) if match else (None, pos)
+
+    ts_match = time_step_re.match(section)
+    if not ts_match:
+        raise ValueError(f'Not a time step section: {section[:40]!r}')
+
+    fields: dict[str, int | float | Vec3[float] | None] = {'time_step': int(ts_match[1])}
+    pos = ts_match.end()
+
+    for name in FLOAT_FIELDS:
+        match, pos   = find(name, float_re, pos)
+        fields[name] = float(match[1]) if match else None
+
+    for name, token in VECTOR_FIELDS:
+        match, pos   = find(token, vector_re, pos)
+        fields[name] = Vec3(*map(float, match.groups())) if match else None
+
+    return TimeStep(**fields)
+
+def read_chunks(log_path: Path, chunk_size: int = 1 << 20) -> Iterator[str]:
+    with open(log_path, 'r') as log:
+        while chunk := log.read(chunk_size):
+            yield chunk
+
+def stream_log(log_path: Path, chunk_size: int = 1 << 20) -> Iterator[TimeStep]:
+    return map(parse_section, split_sections(read_chunks(log_path, chunk_size)))
+
+def stream_log_batches(log_path: Path, batch_size: int = 1 << 16, chunk_size: int = 1 << 20) -> Iterator[pl.DataFrame]:
+    return map(time_steps_to_polars, batched(stream_log(log_path, chunk_size), batch_size))
+
+def read_log_columnar(log_path: Path, block_size: int = 1 << 16) -> Log:
+    '''Same as parse_log(read_log(log_path)), without holding the log text or more than block_size TimeSteps in memory.'''
+    return Log.from_time_steps(stream_log(log_path), block_size)
+
+def read_log_polars(log_path: Path, block_size: int = 1 << 16) -> pl.DataFrame:
+    return read_log_columnar(log_path, block_size).to_polars()
+
 def parse_log(log: str) -> Log:
-    floating       = regex(r'\-?\d+\.\d+').map(float)
-    integer        = regex(r'\d+').map(int)
-    any_char_until = any_char.until
-
-    def float_element(token: str) -> Parser:
-        tok = any_char_until(string(token)) >> string(token)
-        flt = whitespace >> floating
-
-        return (tok >> flt).optional().map(lambda v: (token, v)).desc(token)
-
-    def vector_element(name: str, token: str) -> Parser:
-        tok = any_char_until(string(token)) >> string(token)
-        vec = whitespace >> seq(floating << whitespace, floating << whitespace, floating).map(Vec3._make)
-
-        return (tok >> vec).optional().map(lambda v: (name, v)).desc(token)
-
-    # ts_start    = (any_char_until(string('TIME_STEP'), consume_other=True) >> whitespace >> integer).desc('ts_start')
-    ts_start    = any_char_until(string('TIME_STEP')).desc('ts_start')
-    ts_end      = any_char_until(string('TIME_STEP_END'), consume_other=True).concat().desc('ts_end')
-    ts_section  = (ts_start >> ts_end).desc('ts_section')
-    ts_sections = ts_section.many().desc('ts_sections')
-    time_step   = (string('TIME_STEP') >> whitespace >> integer).map(lambda v: ('time_step', v)).desc('time_step')
-
-    def parse_ts_section(ts_section: str) -> TimeStep:
-        ts_fields = seq(
-            time_step,
-            *map(float_element,
-                 ['acou_kinetic',
-                  'dipo_kinetic',
-                  'short_range',
-                  'long_range',
-                  'dipole_E_field',
-                  'unharmonic',
-                  'homo_strain',
-                  'homo_coupling',
-                  'inho_strain',
-                  'inho_coupling',
-                  'inho_modulation',
-                  'total_energy',
-                  'H_Nose_Poincare',
-                  's_Nose',
-                  'pi_Nose']),
-            *map(lambda tup: vector_element(tup[0], tup[1]),
-                 [('u', '<u>'),
-                  ('u_sigma', 'sigma'),
-                  ('p', '<p>'),
-                  ('p_sigma', 'sigma')])
-        )
+    return Log.from_time_steps(map(parse_section, split_sections([log])))
+
+
+class JsonLogTail:
+    '''Read the records appended to a (growing) feram JSON log since the last poll.
+
+    The log is a JSON array of flat records, ' [ {...} ,{...} ... ]', so every complete '{...}' is a record.
+    Only new bytes are read on each poll. With skip_existing, a log that already exists when the tail is created
+    is considered stale (e.g. left by the previous run in the same directory) until it is rewritten.'''
+    def __init__(self, json_path: Path, schema: Mapping[str, pl.DataType | pl.DataTypeClass] = LOG_SCHEMA, skip_existing: bool = True):
+        self.json_path = json_path
+        self.schema    = schema
+        self.offset    = 0
+        self.buffer    = b''
+        self.stale     = self.stat() if skip_existing else None
+
+    def stat(self) -> Optional[tuple[int, int]]:
+        try:
+            stat = self.json_path.stat()
+            return stat.st_ino, stat.st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def read_new(self) -> bytes:
+        if self.stale is not None and self.stat() == self.stale:
+            return b''
+        self.stale = None
+
+        try:
+            with open(self.json_path, 'rb') as log:
+                if log.seek(0, 2) < self.offset:  # rewritten
+                    self.offset, self.buffer = 0, b''
+                log.seek(self.offset)
+                new = log.read()
+        except FileNotFoundError:
+            return b''
+
+        self.offset += len(new)
+        return new
+
+    def poll(self) -> pl.DataFrame:
+        self.buffer += self.read_new()
+        records: list[dict] = []
+        pos = 0
+
+        while (start := self.buffer.find(b'{', pos)) >= 0 and (end := self.buffer.find(b'}', start)) >= 0:
+            records.append(json.loads(self.buffer[start:end + 1]))
+            pos = end + 1
+
+        self.buffer = self.buffer[pos:]
+
+        return pl.DataFrame(records, schema=self.schema)
 
-        return ts_fields.combine_dict(TimeStep).parse_partial(ts_section)[0]
+def follow_json_log(json_path: Path, is_running: Callable[[], bool], interval: float = 10) -> Iterator[pl.DataFrame]:
+    '''Yield the new records of a JSON log every interval seconds, until is_running() is False.'''
+    tail = JsonLogTail(json_path)
 
-    ts_sections_res = ts_sections.parse_partial(log)[0]
+    while is_running():
+        if len(rows := tail.poll()) > 0:
+            yield rows
+        time.sleep(interval)
 
-    return Log(list(map(parse_ts_section, ts_sections_res)))
+    if len(rows := tail.poll()) > 0:
+        yield rows
 
 
 if __name__ == "__main__":
-    test_path = project_root() / 'output' / 'temp'
-    log_path  = test_path / 'bto.log'
-    log_raw   = read_log(log_path)
-    log       = parse_log(log_raw)
-    df        = log.to_polars()
+    log_path = Path(sys.argv[1]) if len(sys.argv) > 1 else project_root() / 'output' / 'temp' / 'bto.log'
+    df       = read_log_polars(log_path)
 
     print(df)
     print(len(df))
@@ -1,17 +1,27 @@
+import numpy as np
 import polars as pl
 import subprocess as sub
 import os
-import re
 import shutil
 import tarfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from functools import reduce
 from pathlib import Path
 from enum import Enum
+from threading import Thread
 from result import Result, Ok, Err, as_result, do
-from collections.abc import Callable, Iterable, Iterator
-from typing import Any, Self, TypeAlias, cast
+from collections.abc import Callable, Iterable, Iterator, Mapping
+from typing import Any, BinaryIO, NamedTuple, Optional, Self, TypeAlias, cast
 
-from src.lib.Util import project_root, print_result
+from src.lib.Cache import Policy, evict, touch
+from src.lib.Capability import Capabilities, probe
+from src.lib.Log import JsonLogTail
+from src.lib.RunCache import restore, run_key, snapshot, store
+from src.lib.Text import Table, encode_chunks
+from src.lib.Util import cache_root, project_root, print_result
 
 
 safe_run = as_result(Exception)(sub.run)
@@ -22,6 +32,108 @@ def from_completed_process(completed_process: sub.CompletedProcess) -> Result[st
     else:
         return Err(f'returned error code {completed_process.returncode}:\n{completed_process.stderr}')
 
+class Stopped(sub.CompletedProcess):
+    '''A process that run_streaming stopped early, on request of on_json_log.'''
+
+class RotatingFile:
+    '''Text file that is moved to path.1, path.2, ..., path.{backups} once it grows beyond max_bytes.'''
+    def __init__(self, path: Path, max_bytes: int, backups: int):
+        self.path      = path
+        self.max_bytes = max_bytes
+        self.backups   = backups
+        self.file      = path.open('w')
+        self.size      = 0
+
+    def write(self, text: str):
+        if self.size and self.size + len(text) > self.max_bytes:
+            self.rotate()
+        self.file.write(text)
+        self.size += len(text)
+
+    def rotate(self):
+        self.file.close()
+        for i in reversed(range(1, self.backups)):
+            if (older := self.path.with_name(f'{self.path.name}.{i}')).exists():
+                older.replace(self.path.with_name(f'{self.path.name}.{i + 1}'))
+        if self.backups > 0:
+            self.path.replace(self.path.with_name(f'{self.path.name}.1'))
+        self.file = self.path.open('w')
+        self.size = 0
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+STDOUT_MAX_BYTES = 64 * 2**20
+STDOUT_BACKUPS   = 2
+STDERR_TAIL      = 200  # lines of stderr kept for the error message
+
+def run_streaming(args: list, cwd: Path, stdout_path: Path,
+                  on_line: Optional[Callable[[str], Any]] = None,
+                  json_log: Optional[Path] = None,
+                  on_json_log: Optional[Callable[[pl.DataFrame], Any]] = None,
+                  interval: float = 10) -> sub.CompletedProcess:
+    '''Like sub.run(args, capture_output=True), with bounded memory:
+    stdout is written to stdout_path (rotated, see RotatingFile) and passed line by line to on_line;
+    only the last STDERR_TAIL lines of stderr are kept.
+    If on_json_log is given, it's called with the records appended to json_log every interval seconds
+    while the process is running. If it returns True, the process is terminated and Stopped is returned.'''
+    tail        = JsonLogTail(json_log) if json_log and on_json_log else None
+    stderr_tail = deque(maxlen=STDERR_TAIL)
+    errors      = []
+    stopped     = False
+
+    def notify() -> bool:
+        return tail is not None and len(rows := tail.poll()) > 0 and on_json_log(rows) is True
+
+    with (sub.Popen(args, cwd=cwd, stdout=sub.PIPE, stderr=sub.PIPE, universal_newlines=True, bufsize=1) as process,
+          RotatingFile(stdout_path, STDOUT_MAX_BYTES, STDOUT_BACKUPS) as stdout):
+        def read_stdout():
+            # keep draining after a failing on_line, feram would block on a full pipe
+            for line in cast(Iterable[str], process.stdout):
+                stdout.write(line)
+                if on_line and not errors:
+                    try:
+                        on_line(line)
+                    except Exception as e:
+                        errors.append(e)
+                        process.kill()
+
+        readers = [Thread(target=read_stdout, daemon=True),
+                   Thread(target=stderr_tail.extend, args=(process.stderr,), daemon=True)]
+        for reader in readers:
+            reader.start()
+
+        try:
+            while True:
+                try:
+                    process.wait(timeout=interval if tail else None)
+                    break
+                except sub.TimeoutExpired:
+                    if not stopped and notify():
+                        stopped = True
+                        process.terminate()
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            for reader in readers:
+                reader.join()
+
+    if errors:
+        raise errors[0]
+    if not stopped:
+        notify()
+
+    return (Stopped if stopped else sub.CompletedProcess)(args, process.returncode, '', ''.join(stderr_tail))
+
+
 def rel_to_project_root(path: Path) -> Path:
     return path.relative_to(project_root())
 
@@ -168,16 +280,32 @@ class WithDir(Operation):
 
 
 class Remove(Operation):
-    def __init__(self, file: FileIn):
-        super().__init__(lambda: self.do(file))
+    '''missing_ok: succeed if file is already gone, e.g. removed by the run that is being resumed.'''
+    def __init__(self, file: FileIn, missing_ok: bool = False):
+        super().__init__(lambda: self.do(file, missing_ok))
+
+    def do(self, file: FileIn, missing_ok: bool) -> OperationR:
+        if missing_ok and not file.path.exists():
+            return Ok(f'{type(self).__name__}: {file.path} (missing)')
 
-    def do(self, file: FileIn) -> OperationR:
         return do(
             as_result(Exception)(checked.path.unlink)()
             for checked in file.check_preconditions()
         ).map(lambda _: f'{type(self).__name__}: {file.path}').map_err(lambda x: f'{type(self).__name__}: {x}')
 
 
+class RemoveDir(Operation):
+    '''Remove dir and everything in it.'''
+    def __init__(self, dir: DirIn):
+        super().__init__(lambda: self.do(dir))
+
+    def do(self, dir: DirIn) -> OperationR:
+        return do(
+            as_result(Exception)(shutil.rmtree)(checked.path)
+            for checked in dir.check_preconditions()
+        ).map(lambda _: f'{type(self).__name__}: {dir.path}').map_err(lambda x: f'{type(self).__name__}: {x}')
+
+
 class Rename(Operation):
     def __init__(self, src: FileIn | DirIn, dst: FileOut | DirOut):
         super().__init__(lambda: self.do(src, dst))
@@ -256,6 +384,56 @@ class Write(Operation):
         ).map(lambda _: f'{type(self).__name__}: {file.path}').map_err(lambda x: f'{type(self).__name__}: {x}')
 
 
+class WriteTable(Operation):
+    '''Like Write, for tables too large to be held as one string: rows are encoded and streamed in chunks.
+
+    cache_key: identifies the table across runs, e.g. a hash of the parameters generating it (see content_key).
+               The file is then copied from the cache if present, instead of generating the table.
+               The cache also keeps the rows as numbers, {cache_key}{suffix}.npy next to the cached text;
+               only the text is written to file.'''
+    def __init__(self, file: FileOut, get_table: Callable[[], Table], cache_key: Optional[str] = None):
+        super().__init__(lambda: self.do(file, get_table, cache_key))
+
+    @as_result(Exception)
+    def safe_write_table(self, file: FileOut, get_table: Callable[[], Table], cache_key: Optional[str]) -> str:
+        cached = cache_root() / 'tables' / f'{cache_key}{file.path.suffix}' if cache_key else None
+
+        if cached and cached.exists():
+            shutil.copyfile(cached, file.path)
+            touch(cached)
+            touch(cached.with_name(f'{cached.name}.npy'))
+            return 'cached'
+
+        table = get_table()
+        with file.path.open('wb') as f:
+            for i, chunk in enumerate(c for c in encode_chunks(table.columns) if c):
+                f.write(b'\n' + chunk if i else chunk)
+
+        if cached:
+            cached.parent.mkdir(parents=True, exist_ok=True)
+            twin = cached.with_name(f'{cached.name}.npy')
+            # other runs may read the cache concurrently
+            tmp  = cached.with_name(f'{cached.name}.{os.getpid()}.tmp')
+            shutil.copyfile(file.path, tmp)
+            tmp.replace(cached)
+            if table.array is not None:
+                tmp = twin.with_name(f'{twin.name}.{os.getpid()}.tmp')
+                with tmp.open('wb') as f:
+                    np.save(f, table.array)
+                tmp.replace(twin)
+            else:
+                twin.unlink(missing_ok=True)
+            evict(cached.parent)
+
+        return 'written'
+
+    def do(self, file: FileOut, get_table: Callable[[], Table], cache_key: Optional[str]) -> OperationR:
+        return do(
+            self.safe_write_table(checked_out, get_table, cache_key)
+            for checked_out in file.check_preconditions()
+        ).map(lambda how: f'{type(self).__name__}: {file.path} ({how})').map_err(lambda x: f'{type(self).__name__}: {x}')
+
+
 class WriteParquet(Operation):
     def __init__(self, file: FileOut, get_df: Callable[[], pl.DataFrame]):
         super().__init__(lambda: self.do(file, get_df))
@@ -272,51 +450,254 @@ class WriteParquet(Operation):
         ).map(lambda _: f'{type(self).__name__}: {file.path}').map_err(lambda x: f'{type(self).__name__}: {x}')
 
 
+class ParallelGzipWriter:
+    '''Writable gzip stream compressed by threads, like pigz: every block_size bytes are deflated on their own,
+    ending on a byte boundary (Z_SYNC_FLUSH), and the blocks are joined into a single gzip member.
+    Any gzip reader reads it, stream readers included: gzip, tar -xz and Python's gzip/tarfile (also 'r|gz').'''
+    HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'  # deflate, no flags, no mtime, unknown OS (RFC 1952)
+
+    def __init__(self, file: BinaryIO, max_workers: Optional[int] = None, level: int = 6, block_size: int = 4 * 2**20):
+        self.file       = file
+        self.level      = level
+        self.block_size = block_size
+        self.workers    = max_workers or os.cpu_count() or 1
+        self.pool       = ThreadPoolExecutor(self.workers)
+        self.in_flight: deque[Future[bytes]] = deque()
+        self.buffer     = bytearray()
+        self.crc        = 0
+        self.bytes_in   = 0
+        self.bytes_out  = len(self.HEADER)
+        self.file.write(self.HEADER)
+
+    def compress(self, block: bytes, last: bool) -> bytes:
+        # zlib releases the GIL while compressing
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)  # raw deflate
+        return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block: bytes, last: bool = False):
+        self.crc       = zlib.crc32(block, self.crc)
+        self.bytes_in += len(block)
+        self.in_flight.append(self.pool.submit(self.compress, block, last))
+        while len(self.in_flight) > 2 * self.workers:
+            self.write_out()
+
+    def write_out(self):
+        block           = self.in_flight.popleft().result()
+        self.bytes_out += len(block)
+        self.file.write(block)
+
+    def close(self):
+        self.submit(bytes(self.buffer), last=True)  # possibly empty, it ends the deflate stream
+        self.buffer.clear()
+        while self.in_flight:
+            self.write_out()
+        self.pool.shutdown()
+
+        trailer         = self.crc.to_bytes(4, 'little') + (self.bytes_in & 0xffffffff).to_bytes(4, 'little')
+        self.bytes_out += len(trailer)
+        self.file.write(trailer)
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
 class Archive(Operation):
-    def __init__(self, src: DirIn | FileIn, dst: FileOut):
-        super().__init__(lambda: self.do(src, dst))
+    '''Write src to dst as a .tar.gz, compressed by max_workers threads (None: one per CPU), see ParallelGzipWriter.
+
+    exclude: files not to archive, None: every file'''
+    def __init__(self, src: DirIn | FileIn, dst: FileOut, max_workers: Optional[int] = None,
+                 exclude: Optional[Callable[[Path], bool]] = None, level: int = 6):
+        super().__init__(lambda: self.do(src, dst, max_workers, exclude, level))
 
     @as_result(Exception)
-    def safe_archive(self, src, dst) -> None:
-        with tarfile.open(dst.path, 'w:gz') as tar:
-            tar.add(src.path, arcname=src.path.name)
+    def safe_archive(self, src, dst, max_workers: Optional[int], exclude: Optional[Callable[[Path], bool]], level: int) -> str:
+        def tar_filter(info: tarfile.TarInfo) -> Optional[tarfile.TarInfo]:
+            return None if exclude and info.isfile() and exclude(src.path.parent / info.name) else info
+
+        start = time.perf_counter()
+        with (dst.path.open('wb') as f,
+              ParallelGzipWriter(f, max_workers, level) as gz,
+              tarfile.open(fileobj=cast(BinaryIO, gz), mode='w|') as tar):
+            tar.add(src.path, arcname=src.path.name, filter=tar_filter)
+        elapsed = time.perf_counter() - start
 
-    def do(self, src, dst) -> OperationR:
+        return (f'{gz.bytes_in / 2**20:.1f} MiB -> {gz.bytes_out / 2**20:.1f} MiB '
+                f'in {elapsed:.1f} s ({gz.bytes_in / 2**20 / max(elapsed, 1e-9):.1f} MiB/s)')
+
+    def do(self, src, dst, max_workers: Optional[int], exclude: Optional[Callable[[Path], bool]], level: int) -> OperationR:
         return do(
             Ok(res)
             for checked_src in src.check_preconditions()
             for checked_dst in dst.check_preconditions()
-            for res in self.safe_archive(checked_src, checked_dst)
-        ).map(lambda _: f'{type(self).__name__}: {src.path} >> {dst.path}')\
+            for res in self.safe_archive(checked_src, checked_dst, max_workers, exclude, level)
+        ).map(lambda throughput: f'{type(self).__name__}: {src.path} >> {dst.path}, {throughput}')\
         .map_err(lambda x: f'{type(self).__name__}: {x}')
 
 
 class Feram(Operation):
-    def __init__(self, feram_bin: Exec, feram_input: FileIn):
-        super().__init__(lambda: self.do(feram_bin, feram_input))
-
-    def do(self, feram_bin: Exec, feram_input: FileIn) -> OperationR:
-        def supports_json_log(version: str) -> Result[bool, bool]:
-            if re.search('json_log', version):
-                return Ok(True)
+    '''Run feram on feram_input, in the directory of feram_input.
+    feram's stdout goes to {input stem}.stdout next to it, see run_streaming.
+
+    on_line:     called with every line of feram's stdout, e.g. to show progress
+    on_json_log: called with the new records of the JSON log every poll_interval seconds while feram is running;
+                 returning True stops feram early, e.g. Convergence.ConvergenceMonitor(stop=True).
+                 A stopped run is an Err: the outputs feram writes at the end of the run (.avg, .dipoRavg,
+                 the last .coord) are missing, so the steps reading them can't follow.
+    cache:       opt in to the run cache (see RunCache) with its eviction policy; None: always run feram.
+                 When the same binary already ran on the same inputs, its outputs are restored instead.
+                 Every output of a cached run is stored, so size the policy for the runs it covers.
+                 Runs with on_json_log are never cached, as it may stop them early.'''
+    def __init__(self, feram_bin: Exec, feram_input: FileIn,
+                 on_json_log: Optional[Callable[[pl.DataFrame], Any]] = None, poll_interval: float = 10,
+                 on_line: Optional[Callable[[str], Any]] = None, cache: Optional[Policy] = None):
+        super().__init__(lambda: self.do(feram_bin, feram_input, on_json_log, poll_interval, on_line, cache))
+
+    def do(self, feram_bin: Exec, feram_input: FileIn,
+           on_json_log: Optional[Callable[[pl.DataFrame], Any]], poll_interval: float,
+           on_line: Optional[Callable[[str], Any]], cache: Optional[Policy]) -> OperationR:
+        def supports_json_log(capabilities: Capabilities) -> Result[Capabilities, str]:
+            if capabilities.supports('json_log'):
+                return Ok(capabilities)
             else:
-                return Err(False)
+                return Err(f'json_log not supported by {capabilities.version}')
+
+        def cache_key(feram_input: Path, capabilities: Capabilities) -> Result[Optional[str], Any]:
+            if cache is None or on_json_log is not None:
+                return Ok(None)
+            return as_result(Exception)(run_key)(feram_input, capabilities.sha256)
+
+        def from_feram_process(completed_process: sub.CompletedProcess) -> Result[str, str]:
+            if isinstance(completed_process, Stopped):
+                return Err('stopped early by on_json_log, the outputs written at the end of the run are missing '
+                           f'(.avg, .dipoRavg, last .coord of {feram_input.path.name})')
+            return from_completed_process(completed_process)
+
+        def run(feram_bin: Path, feram_input: Path) -> Result[sub.CompletedProcess, Any]:
+            # run next to the input file, so that concurrent runs don't depend on os.chdir
+            return as_result(Exception)(run_streaming)(
+                [feram_bin, feram_input],
+                cwd         = feram_input.parent,
+                stdout_path = feram_input.with_suffix('.stdout'),
+                on_line     = on_line,
+                json_log    = feram_input.with_suffix('.json'),
+                on_json_log = on_json_log,
+                interval    = poll_interval)
+
+        def run_cached(feram_bin: Path, feram_input: Path, key: Optional[str]) -> Result[str, Any]:
+            '''Returns a note for the log: whether the outputs were restored.'''
+            if key is None:
+                return run(feram_bin, feram_input).and_then(from_feram_process).map(lambda _: '')
+
+            directory = feram_input.parent
+            return do(
+                Ok(note)
+                for restored in as_result(Exception)(restore)(key, directory)
+                for note in (Ok(f': restored {len(restored)} files from cache {key[:12]}') if restored is not None else do(
+                    Ok('')
+                    for before in as_result(Exception)(snapshot)(directory)
+                    for completed_process in run(feram_bin, feram_input)
+                    for _ in from_feram_process(completed_process)
+                    for _ in as_result(Exception)(store)(key, directory, before, cache)
+                ))
+            )
 
         return do(
-            Ok(res)
+            Ok(note)
             for checked_feram_bin in feram_bin.check_preconditions()
             for checked_feram_input in feram_input.check_preconditions()
-            for version in from_completed_process(
-                sub.run([checked_feram_bin.path, '-v'],
-                        capture_output=True,
-                        universal_newlines=True))
-            for _ in supports_json_log(version)
-            for res in from_completed_process(
-                # sub.run([checked_feram_bin.path, checked_feram_input.path]))
-                sub.run([checked_feram_bin.path, checked_feram_input.path],
-                        capture_output=True,
-                        universal_newlines=True))
-        ).map(lambda _: f'{type(self).__name__}').map_err(lambda x: f'{type(self).__name__}: {x}')
+            for capabilities in probe(checked_feram_bin.path)
+            for _ in supports_json_log(capabilities)
+            for key in cache_key(checked_feram_input.path, capabilities)
+            for note in run_cached(checked_feram_bin.path, checked_feram_input.path, key)
+        ).map(lambda note: f'{type(self).__name__}{note}').map_err(lambda x: f'{type(self).__name__}: {x}')
+
+
+class Lazy(Operation):
+    '''Build the operation when it is run, e.g. when it depends on files created by earlier operations.'''
+    def __init__(self, get_operation: Callable[[], Operation]):
+        self.get_operation = get_operation
+
+    def run(self) -> OperationR:
+        return self.get_operation().run()
+
+
+class Node(NamedTuple):
+    operation: Operation
+    after: Iterable[str] = ()  # names of the nodes that have to succeed first
+
+
+class OperationGraph(Operation):
+    '''Run every operation as soon as the operations it depends on have succeeded, at most max_workers at a time.
+
+    The operations run in threads, so they must not depend on the current working directory (no Cd/WithDir).
+    Once an operation fails, operations that haven't started yet are cancelled and the failure is returned.
+    Otherwise, the result is a dict of the values of all nodes, in the order of nodes.'''
+    def __init__(self, nodes: Mapping[str, Node], max_workers: int | None = None):
+        self.nodes       = nodes
+        self.max_workers = max_workers
+
+    def run(self) -> OperationR:
+        pending: dict[str, Node]      = dict(self.nodes)
+        running: dict[Future, str]    = {}
+        done: dict[str, Any]          = {}
+        failure: Optional[OperationR] = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            def start_ready() -> None:
+                for name, node in list(pending.items()):
+                    if all(dep in done for dep in node.after):
+                        running[pool.submit(node.operation.run)] = name
+                        del pending[name]
+
+            start_ready()
+            while running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    name = running.pop(future)
+                    if future.cancelled():
+                        continue
+
+                    res = future.result()
+                    if res.is_ok():
+                        done[name] = res.ok_value
+                    elif failure is None:
+                        failure = res
+                        for queued in running:
+                            queued.cancel()
+
+                if failure is None:
+                    start_ready()
+
+        if failure is not None:
+            return failure
+        elif pending:
+            res = Err(f'{type(self).__name__}: unresolvable dependencies of {", ".join(pending)}')
+            print_result(res)
+            return res
+        else:
+            return Ok({name: done[name] for name in self.nodes})
+
+
+class Parallel(Operation):
+    '''Run independent operations concurrently on at most max_workers threads, see OperationGraph.'''
+    def __init__(self, operations: Iterable[Operation], max_workers: int | None = None):
+        self.operations  = operations
+        self.max_workers = max_workers
+
+    def run(self) -> OperationR:
+        nodes = {str(i): Node(op) for i, op in enumerate(self.operations)}
+        return OperationGraph(nodes, self.max_workers).run().map(lambda values: list(values.values()))
 
 
 class OperationSequence(Operation):
@@ -1,19 +1,21 @@
+import multiprocessing
+import os
 import re
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from collections import deque
 from collections.abc import Sequence
+from concurrent.futures import Future, ProcessPoolExecutor
 from typing import Optional
 from numpy.typing import NDArray
 
+from src.lib.Coord import DIPO_COLUMNS, load_frame
 from src.lib.Operations import *
 
 
 def parse_dipo_df(fname: Path) -> pd.DataFrame:
-    columns = ['x', 'y', 'z', 'ux', 'uy', 'uz']
-    pd_df   = pd.read_table(fname, sep=r'\s+', header=None).iloc[:, 0:6]
-    renamed = pd_df.rename(columns=dict(enumerate(columns)))
-    return renamed
+    return load_frame(fname, DIPO_COLUMNS).to_pandas()
 
 
 def parse_mod(fname: Path) -> NDArray:
@@ -47,48 +49,77 @@ def vorticity3d_df(dipo_df: pd.DataFrame, dx: float, dy: float, dz: float) -> pd
     return df
 
 
-def write_dump(dump_path: Path, dipo_files: Sequence[Path], mod_file: Optional[Path]):
+def dump_header(i: int, dipo_file: Path, df: pd.DataFrame) -> str:
+    return ('ITEM: TIMESTEP\n'
+        f'{i} {dipo_file.name}\n'
+        'ITEM: NUMBER OF ATOMS\n'
+        f'{len(df)}\n'
+        'ITEM: BOX BOUNDS pp pp pp\n'
+        f'0 {df.x.max() + 1}\n'
+        f'0 {df.y.max() + 1}\n'
+        f'0 {df.z.max() + 1}\n'
+        'ITEM: ATOMS id type q xu yu zu mux muy muz vx vy vz\n'
+    )
+
+ATOM_FORMAT = '%d %d %d %d %d %d %.6f %.6f %.6f %.6f %.6f %.6f\n'
+
+def dump_atoms(df: pd.DataFrame, modulation: NDArray, atom_types: dict) -> str:
+    '''The atoms of a frame, formatted as a whole: %-formatting of floats matches f'{v:.6f}', %d of floats matches int(v).'''
+    types = np.vectorize(atom_types.__getitem__, otypes=[np.int64])(modulation) if len(modulation) else modulation
+    rows  = np.column_stack([
+        np.arange(1, len(df) + 1), types, modulation,
+        *(df[c].to_numpy() for c in ['x', 'y', 'z', 'ux', 'uy', 'uz', 'vtx', 'vty', 'vtz'])
+    ]).astype(np.float64)
+
+    return (ATOM_FORMAT * len(df)) % tuple(rows.ravel().tolist())
+
+def dump_frame(i: int, dipo_file: Path, modulation: Optional[NDArray], atom_types: dict) -> str:
+    df = vorticity3d_df(parse_dipo_df(dipo_file), dx = 1, dy = 1, dz = 1)
+
+    modulation2 = modulation if modulation is not None else np.repeat(0, len(df))
+
+    return dump_header(i, dipo_file, df) + dump_atoms(df, modulation2, atom_types)
+
+def write_dump(dump_path: Path, dipo_files: Sequence[Path], mod_file: Optional[Path], max_workers: Optional[int] = 1):
+    '''max_workers: frames are parsed and formatted by that many processes (None: one per CPU),
+    at most 2 * max_workers of them at a time, and written in order.'''
     modulation = parse_mod(mod_file)[:, 3] if mod_file else np.array([0])  # _xm, _ym, _zm, mm = mod[:,0], mod[:,1], mod[:,2], mod[:,3]
     atom_types = { t: i + 1 for i, t in enumerate(np.unique(modulation)) }
+    frame_mod  = modulation if mod_file else None
+
+    workers    = max_workers or os.cpu_count() or 1
 
     with open(dump_path, 'w') as dump:
-        for i, dump_path in enumerate(dipo_files):
-            df = vorticity3d_df(parse_dipo_df(dump_path), dx = 1, dy = 1, dz = 1)
-
-            x, y, z       = df.x, df.y, df.z
-            ux, uy, uz    = df.ux, df.uy, df.uz
-            vtx, vty, vtz = df.vtx, df.vty, df.vtz
-
-            modulation2 = modulation if mod_file else np.repeat(0, len(x))
-            n_atoms     = len(df)
-
-            dump.write('ITEM: TIMESTEP\n'
-                f'{i} {dump_path.name}\n'
-                'ITEM: NUMBER OF ATOMS\n'
-                f'{n_atoms}\n'
-                'ITEM: BOX BOUNDS pp pp pp\n'
-                f'0 {df.x.max() + 1}\n'
-                f'0 {df.y.max() + 1}\n'
-                f'0 {df.z.max() + 1}\n'
-                'ITEM: ATOMS id type q xu yu zu mux muy muz vx vy vz\n'
-            )
-            for j in range(n_atoms):
-                dump.write(f'{j + 1:d} {atom_types[modulation2[j]]:d} {modulation2[j]:d} '
-                    f'{int(x[j]):d} {int(y[j]):d} {int(z[j]):d} '
-                    f'{ux[j]:.6f} {uy[j]:.6f} {uz[j]:.6f} '
-                    f'{vtx[j]:.6f} {vty[j]:.6f} {vtz[j]:.6f}\n'
-                )
+        if workers == 1 or len(dipo_files) == 1:
+            for i, dipo_file in enumerate(dipo_files):
+                dump.write(dump_frame(i, dipo_file, frame_mod, atom_types))
+            return
+
+        # forkserver: the caller may be running other operations in threads
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver')) as pool:
+            in_flight: deque[Future[str]] = deque()
+
+            for i, dipo_file in enumerate(dipo_files):
+                in_flight.append(pool.submit(dump_frame, i, dipo_file, frame_mod, atom_types))
+                if len(in_flight) >= 2 * workers:
+                    dump.write(in_flight.popleft().result())
+
+            while in_flight:
+                dump.write(in_flight.popleft().result())
 
 
 class WriteOvito(Operation):
-    def __init__(self, input_dir: DirIn, output_file: FileOut, ext: str, mod_file: Optional[FileIn] = None) -> None:
-        super().__init__(lambda: self.do(input_dir, output_file, ext, mod_file))
+    '''max_workers: processes parsing and formatting frames, see write_dump'''
+    def __init__(self, input_dir: DirIn, output_file: FileOut, ext: str, mod_file: Optional[FileIn] = None,
+                 max_workers: Optional[int] = 1) -> None:
+        super().__init__(lambda: self.do(input_dir, output_file, ext, mod_file, max_workers))
 
     @as_result(Exception)
-    def safe_write(self, file: FileOut, dipo_files: Sequence[Path], mod_file: Optional[FileIn]):
-        write_dump(file.path, dipo_files, mod_file.path if mod_file else None)
+    def safe_write(self, file: FileOut, dipo_files: Sequence[Path], mod_file: Optional[FileIn], max_workers: Optional[int]):
+        write_dump(file.path, dipo_files, mod_file.path if mod_file else None, max_workers = max_workers)
 
-    def do(self, input_dir: DirIn, output_file: FileOut, ext: str, mod_file: Optional[FileIn]) -> OperationR:
+    def do(self, input_dir: DirIn, output_file: FileOut, ext: str, mod_file: Optional[FileIn],
+           max_workers: Optional[int]) -> OperationR:
         def natsort(file: Path) -> list[str | int]:
             return [int(t) if t.isdigit() else t.lower() for t in re.split(r'(\d+)', file.name)]
 
@@ -106,5 +137,6 @@ class WriteOvito(Operation):
             for checked_dipos in dipo_files_exist(dipo_files)
             for checked_out   in output_file.check_preconditions()
             for checked_in    in (mod_file.check_preconditions() if mod_file else Ok(None))
-            for res in self.safe_write(checked_out, checked_dipos, checked_in)
+            for res in self.safe_write(checked_out, checked_dipos, checked_in, max_workers)
         ).map(lambda _: f'{type(self).__name__}: {output_file.path}').map_err(lambda x: f'{type(self).__name__}: {x}')
+
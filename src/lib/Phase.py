@@ -0,0 +1,50 @@
+'''
+Phase of the polarization (px, py, pz), for many sites or time steps at once.
+Same classification as Visualization.determine_phase, condition by condition.
+'''
+
+import numpy as np
+import pandas as pd
+import polars as pl
+from numpy.typing import ArrayLike, NDArray
+
+
+PHASES = ('R', 'Ma', 'Mb', 'Tri', 'O', 'Mc', 'T', 'C', '???')
+
+PhaseEnum = pl.Enum(PHASES)
+
+
+def phase_codes(p: ArrayLike, zero_noise: float = 0.5) -> NDArray[np.int8]:
+    '''p: (N, 3) polarization. Returns indices into PHASES.'''
+    px, py, pz = np.abs(np.asarray(p, dtype=np.float64).reshape(-1, 3)).T
+    z          = zero_noise
+
+    # same names as determine_phase: [xyz]_ > noise, [xyz]0 < noise, d_xy = |px - py|, ...
+    x_, y_, z_ = px > z, py > z, pz > z
+    x0, y0, z0 = px < z, py < z, pz < z
+    d_xy       = np.abs(px - py)
+    d_xz       = np.abs(px - pz)
+    d_yz       = np.abs(pz - py)
+
+    all_ = x_ & y_ & z_
+    ma   = (d_xy < z) & (d_xz > z) & (px < pz) | (d_xz < z) & (d_xy > z) & (px < py) | (d_yz < z) & (d_xz > z) & (pz < px)
+    mb   = (d_xy < z) & (d_xz > z) & (px > pz) | (d_xz < z) & (d_xy > z) & (px > py) | (d_yz < z) & (d_xz > z) & (pz > px)
+
+    conditions = [
+        all_ & (d_xy < z) & (d_xz < z),                                                               # R   (a,a,a)
+        all_ & ma,                                                                                     # Ma  (a,a,b), a<b
+        all_ & mb,                                                                                     # Mb  (a,a,b), a>b
+        all_,                                                                                          # Tri (a,b,c)
+        x0 & y_ & z_ & (d_yz < z) | x_ & y0 & z_ & (d_xz < z) | x_ & y_ & z0 & (d_xy < z),             # O   (a,a,0)
+        x0 & y_ & z_ & (d_yz > z) | x_ & y0 & z_ & (d_xz > z) | x_ & y_ & z0 & (d_xy > z),             # Mc  (a,b,0)
+        x0 & y0 & z_ | x_ & y0 & z0 | (px < 0.5) & (py > 0.5) & (pz < 0.5),                            # T   (a,0,0); 0.5 as in determine_phase
+        x0 & y0 & z0,                                                                                  # C   (0,0,0)
+    ]
+
+    return np.select(conditions, np.arange(len(conditions), dtype=np.int8), default=PHASES.index('???')).astype(np.int8)
+
+def determine_phases(p: ArrayLike, zero_noise: float = 0.5) -> pd.Categorical:
+    return pd.Categorical.from_codes(phase_codes(p, zero_noise), categories=PHASES)
+
+def phase_series(p: ArrayLike, zero_noise: float = 0.5, name: str = 'phase') -> pl.Series:
+    return pl.Series(name, np.array(PHASES)[phase_codes(p, zero_noise)], dtype=PhaseEnum)
@@ -0,0 +1,68 @@
+'''
+Content-addressed cache of feram runs: a run is skipped when the same binary already ran on the same inputs.
+
+The key of a run hashes the .feram file, the auxiliary inputs feram reads next to it ({stem}.restart, ...)
+and the sha256 of the binary. The entry of a key is a zip of the files the run wrote or changed in its directory,
+kept in the cache ("runs") and evicted least recently used first.
+'''
+
+import os
+import threading
+import zipfile
+from pathlib import Path
+from typing import Optional
+
+from src.lib.Cache import Policy, cache_dir, evict, touch
+from src.lib.Capability import sha256
+from src.lib.Util import content_key
+
+
+INPUT_SUFFIXES = ('.restart', '.localfield', '.defects', '.modulation')  # read by feram as {stem}{suffix}
+
+Snapshot = dict[str, tuple[int, int]]  # name -> (mtime_ns, size) of the files of a directory
+
+
+def run_key(feram_input: Path, binary_sha256: str) -> str:
+    inputs = [feram_input.with_suffix(suffix) for suffix in INPUT_SUFFIXES]
+
+    return content_key(
+        feram_input.read_bytes(),
+        *(f'{path.suffix}:{sha256(path)}' for path in inputs if path.is_file()),
+        binary_sha256,
+    )
+
+def entry_path(key: str) -> Path:
+    return cache_dir('runs') / f'{key}.zip'
+
+def snapshot(directory: Path) -> Snapshot:
+    return {entry.name: (entry.stat().st_mtime_ns, entry.stat().st_size)
+            for entry in os.scandir(directory) if entry.is_file()}
+
+def restore(key: str, directory: Path) -> Optional[list[str]]:
+    '''Write the outputs of the cached run key to directory. Returns their names, None if key is not cached.'''
+    entry = entry_path(key)
+
+    try:
+        with zipfile.ZipFile(entry) as archive:
+            archive.extractall(directory)
+            names = archive.namelist()
+    except FileNotFoundError:
+        return None
+
+    touch(entry)
+    return names
+
+def store(key: str, directory: Path, before: Snapshot, policy: Policy = Policy()) -> list[str]:
+    '''Cache the files of directory that are new or changed since before. Returns their names.'''
+    after   = snapshot(directory)
+    changed = sorted(name for name, stat in after.items() if before.get(name) != stat)
+    entry   = entry_path(key)
+    tmp     = entry.with_name(f'{entry.stem}.{os.getpid()}.{threading.get_ident()}.tmp.zip')  # concurrent runs of the same key
+
+    with zipfile.ZipFile(tmp, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        for name in changed:
+            archive.write(directory / name, name)
+
+    tmp.replace(entry)
+    evict(entry.parent, policy)
+    return changed
@@ -0,0 +1,128 @@
+'''
+Column schemas of feram's output tables, shared by every reader.
+
+Whitespace separated tables (.avg, .hl; see Tables.scan_table) list their columns in file order.
+'''
+
+import polars as pl
+
+
+Schema = dict[str, pl.DataType | pl.DataTypeClass]
+
+
+# {sim_name}.avg: one line per run, averaged over n_average
+AVG_SCHEMA: Schema = {
+    'kelvin':            pl.Float64,
+    'Ex':                pl.Float64,
+    'Ey':                pl.Float64,
+    'Ez':                pl.Float64,
+    's_xx':              pl.Float64,
+    's_yy':              pl.Float64,
+    's_zz':              pl.Float64,
+    's_yz':              pl.Float64,
+    's_xz':              pl.Float64,
+    's_xy':              pl.Float64,
+    'u1':                pl.Float64,
+    'u2':                pl.Float64,
+    'u3':                pl.Float64,
+    'uu1':               pl.Float64,
+    'uu2':               pl.Float64,
+    'uu3':               pl.Float64,
+    'uu4':               pl.Float64,
+    'uu5':               pl.Float64,
+    'uu6':               pl.Float64,
+    'e_dipo_kinetic':    pl.Float64,
+    'e_long_range':      pl.Float64,
+    'e_dipole_E_field':  pl.Float64,
+    'e_unharmonic':      pl.Float64,
+    'e_homo_strain':     pl.Float64,
+    'e_homo_coupling':   pl.Float64,
+    'e_inho_strain':     pl.Float64,
+    'e_inho_coupling':   pl.Float64,
+    'e_total':           pl.Float64,
+    'e_Nose_Poincare':   pl.Float64,
+    'e2':                pl.Float64,
+    'dipo_kinetic_true': pl.Float64,
+    'e_acou_kinetic':    pl.Float64,
+    'e_short_range':     pl.Float64,
+    'e_inho_modulation': pl.Float64,
+    'p1':                pl.Float64,
+    'p2':                pl.Float64,
+    'p3':                pl.Float64,
+    'pp1':               pl.Float64,
+    'pp2':               pl.Float64,
+    'pp3':               pl.Float64,
+    'pp4':               pl.Float64,
+    'pp5':               pl.Float64,
+    'pp6':               pl.Float64,
+}
+
+# {sim_name}.hl: one line every n_hl_freq time steps
+HL_SCHEMA: Schema = {
+    'step':              pl.Int64,
+    'kelvin':            pl.Float64,
+    'Ex':                pl.Float64,
+    'Ey':                pl.Float64,
+    'Ez':                pl.Float64,
+    's_xx':              pl.Float64,
+    's_yy':              pl.Float64,
+    's_zz':              pl.Float64,
+    's_yz':              pl.Float64,
+    's_xz':              pl.Float64,
+    's_xy':              pl.Float64,
+    'u1':                pl.Float64,
+    'u2':                pl.Float64,
+    'u3':                pl.Float64,
+    'uu1':               pl.Float64,
+    'uu2':               pl.Float64,
+    'uu3':               pl.Float64,
+    'uu4':               pl.Float64,
+    'uu5':               pl.Float64,
+    'uu6':               pl.Float64,
+    'e_dipo_kinetic':    pl.Float64,
+    'e_short_range':     pl.Float64,
+    'e_long_range':      pl.Float64,
+    'e_dipole_E_field':  pl.Float64,
+    'e_unharmonic':      pl.Float64,
+    'e_homo_strain':     pl.Float64,
+    'e_homo_coupling':   pl.Float64,
+    'e_inho_strain':     pl.Float64,
+    'e_inho_coupling':   pl.Float64,
+    'e_inho_modulation': pl.Float64,
+    'e_total':           pl.Float64,
+    'e_Nose_Poincare':   pl.Float64,
+    'e2':                pl.Float64,
+    'dipo_kinetic_true': pl.Float64,
+    'e_acou_kinetic':    pl.Float64,
+}
+
+# {sim_name}.json, the JSON log written by feram builds supporting json_log
+LOG_SCHEMA: Schema = {
+    'time_step':       pl.Int64,
+    'acou_kinetic':    pl.Float64,
+    'dipo_kinetic':    pl.Float64,
+    'short_range':     pl.Float64,
+    'long_range':      pl.Float64,
+    'dipole_E_field':  pl.Float64,
+    'unharmonic':      pl.Float64,
+    'homo_strain':     pl.Float64,
+    'homo_coupling':   pl.Float64,
+    'inho_strain':     pl.Float64,
+    'inho_coupling':   pl.Float64,
+    'inho_modulation': pl.Float64,
+    'total_energy':    pl.Float64,
+    'H_Nose_Poincare': pl.Float64,
+    's_Nose':          pl.Float64,
+    'pi_Nose':         pl.Float64,
+    'u':               pl.List(pl.Float64),
+    'u_sigma':         pl.List(pl.Float64),
+    'p':               pl.List(pl.Float64),
+    'p_sigma':         pl.List(pl.Float64),
+}
+
+# by file extension
+SCHEMAS: dict[str, Schema] = {
+    'avg':  AVG_SCHEMA,
+    'hl':   HL_SCHEMA,
+    'json': LOG_SCHEMA,
+}
@@ -0,0 +1,77 @@
+'''
+Per-frame statistics of the polarization of a run's lattice frames (.coord, .dipoRavg), in one table.
+
+Frames are read one at a time (memory-mapped, see Coord.load_frame), so memory stays that of a single frame.
+Every row: the FrameInfo of the frame, mean and variance of P, fraction of sites in each phase (Phase.PHASES),
+and the 2D histogram of (px, py) over fixed bins, the same for every frame of every run.
+'''
+
+import numpy as np
+import polars as pl
+from pathlib import Path
+from collections.abc import Callable, Iterable
+from typing import Any, NamedTuple
+
+from src.lib.Coord import DIPO_COLUMNS, load_frame
+from src.lib.Operations import *
+from src.lib.Phase import PHASES, phase_codes
+from src.lib.Trajectory import KIND_COLUMNS, FrameInfo
+
+
+class Bins(NamedTuple):
+    low: float  = -60.  # [μC/cm²]
+    high: float = 60.   # [μC/cm²]
+    n: int      = 120   # per axis
+
+    @property
+    def edges(self) -> list[float]:
+        return np.linspace(self.low, self.high, self.n + 1).tolist()
+
+
+def frame_statistics(path: Path, info: FrameInfo, factor: float, bins: Bins = Bins(), zero_noise: float = 0.5) -> dict[str, Any]:
+    '''factor: displacement to polarization, FeramConfig.polarization_parameters.factor'''
+    frame  = load_frame(path, DIPO_COLUMNS, KIND_COLUMNS[info.kind])
+    p      = np.column_stack([frame.columns[name] for name in DIPO_COLUMNS]) * factor
+    p_norm = np.linalg.norm(p, axis=1)
+    phases = np.bincount(phase_codes(p, zero_noise), minlength=len(PHASES)) / len(p)
+    pxy, _, _ = np.histogram2d(p[:, 0], p[:, 1], bins=bins.n, range=[(bins.low, bins.high)] * 2)
+
+    return {
+        **info._asdict(),
+        'sites':       len(p),
+        **{f'mean_{axis}': m for axis, m in zip(['px', 'py', 'pz'], p.mean(axis=0).tolist())},
+        **{f'var_{axis}': v for axis, v in zip(['px', 'py', 'pz'], p.var(axis=0).tolist())},
+        'mean_p':      float(p_norm.mean()),
+        'var_p':       float(p_norm.var()),
+        **{f'phase_{name}': fraction for name, fraction in zip(PHASES, phases.tolist())},
+        'pxy_hist':    pxy.astype(np.int64).tolist(),  # [px bin][py bin]; sites outside the bins are not counted
+        'pxy_edges':   bins.edges,
+    }
+
+def statistics_table(frames: Iterable[tuple[Path, FrameInfo]], factor: float, bins: Bins = Bins(), zero_noise: float = 0.5) -> pl.DataFrame:
+    return pl.DataFrame(
+        [frame_statistics(path, info, factor, bins, zero_noise) for path, info in frames],
+        schema_overrides={'time_step': pl.Int64, 'pxy_hist': pl.List(pl.List(pl.Int64))}
+    )
+
+
+class WriteStatistics(Operation):
+    '''statistics_table of the frames returned by get_frames, as parquet.'''
+    def __init__(self, output_file: FileOut, get_frames: Callable[[], Iterable[tuple[Path, FrameInfo]]], factor: float,
+                 bins: Bins = Bins()):
+        super().__init__(lambda: self.do(output_file, get_frames, factor, bins))
+
+    @as_result(Exception)
+    def safe_write(self, file: FileOut, get_frames: Callable[[], Iterable[tuple[Path, FrameInfo]]], factor: float,
+                   bins: Bins) -> int:
+        df = statistics_table(get_frames(), factor, bins)
+        df.write_parquet(file.path)
+        return len(df)
+
+    def do(self, output_file: FileOut, get_frames: Callable[[], Iterable[tuple[Path, FrameInfo]]], factor: float,
+           bins: Bins) -> OperationR:
+        return do(
+            Ok(n)
+            for checked_out in output_file.check_preconditions()
+            for n in self.safe_write(checked_out, get_frames, factor, bins)
+        ).map(lambda n: f'{type(self).__name__}: {output_file.path} ({n} frames)').map_err(lambda x: f'{type(self).__name__}: {x}')
@@ -0,0 +1,80 @@
+'''
+Lazy readers of feram's whitespace separated tables (.avg, .hl), with the schemas of Schema.
+
+scan_table returns a polars LazyFrame: select and filter it before collecting, and only the selected columns
+are converted from text. iter_table reads a table of any size in chunks of lines.
+
+df = scan_table(path).filter(pl.col('kelvin') < 300).select('kelvin', 'u1').collect()
+'''
+
+import pandas as pd
+import polars as pl
+from pathlib import Path
+from collections.abc import Iterator, Sequence
+from typing import Optional
+
+from src.lib.Schema import SCHEMAS, Schema
+
+
+CHUNK_BYTES = 64 * 2**20
+
+
+def schema_of(path: Path) -> Schema:
+    return SCHEMAS[path.suffix[1:]]
+
+def parse_lines(lines: pl.LazyFrame, schema: Schema) -> pl.LazyFrame:
+    '''lines: a single String column "line". Lines are split once; every column of schema is then its own expression,
+    so the columns that are not selected are never converted.'''
+    tokens = (pl.col('line').str.replace_all('\t', ' ', literal=True).str.strip_chars().str.split(' ')
+              .list.eval(pl.element().filter(pl.element() != '')))
+
+    return lines.select(tokens.alias('tokens')).filter(pl.col('tokens').list.len() > 0).select(
+        pl.col('tokens').list.get(i, null_on_oob=True).cast(dtype).alias(name)
+        for i, (name, dtype) in enumerate(schema.items())
+    )
+
+def read_lines(source: Path | bytes) -> pl.LazyFrame:
+    # \x1f never occurs in feram's tables: every line is one field
+    options = dict(has_header=False, separator='\x1f', quote_char=None, new_columns=['line'], schema={'line': pl.String})
+    return pl.scan_csv(source, **options) if isinstance(source, Path) else pl.read_csv(source, **options).lazy()
+
+def scan_table(path: Path, schema: Optional[Schema] = None) -> pl.LazyFrame:
+    '''schema: by default, that of the file extension (Schema.SCHEMAS).'''
+    return parse_lines(read_lines(path), schema or schema_of(path))
+
+def iter_table(path: Path, columns: Optional[Sequence[str]] = None, predicate: Optional[pl.Expr] = None,
+               schema: Optional[Schema] = None, chunk_bytes: int = CHUNK_BYTES) -> Iterator[pl.DataFrame]:
+    '''scan_table(path).filter(predicate).select(columns), about chunk_bytes of the file at a time.'''
+    schema = schema or schema_of(path)
+
+    def parse(block: bytes) -> pl.DataFrame:
+        lf = parse_lines(read_lines(block), schema)
+        lf = lf if predicate is None else lf.filter(predicate)
+        return (lf if columns is None else lf.select(columns)).collect()
+
+    with open(path, 'rb') as f:
+        rest = b''
+        while block := f.read(chunk_bytes):
+            block = rest + block
+            cut   = block.rfind(b'\n') + 1
+            rest  = block[cut:]
+            if cut:
+                yield parse(block[:cut])
+        if rest.strip():
+            yield parse(rest)
+
+
+def polarization(factor: float, u: Sequence[str] = ('u1', 'u2', 'u3')) -> list[pl.Expr]:
+    '''px, py, pz, p_total from the displacement columns u; factor: FeramConfig.polarization_parameters.factor'''
+    px, py, pz = (pl.col(name) * factor for name in u)
+
+    return [
+        px.alias('px'),
+        py.alias('py'),
+        pz.alias('pz'),
+        (px**2 + py**2 + pz**2).sqrt().alias('p_total'),
+    ]
+
+def table_to_pandas(df: pl.DataFrame) -> pd.DataFrame:
+    '''Without pyarrow: numeric columns are handed over as NumPy arrays.'''
+    return pd.DataFrame({name: df[name].to_numpy() for name in df.columns})
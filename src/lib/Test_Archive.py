@@ -0,0 +1,99 @@
+import gzip
+import io
+import os
+import tarfile
+import tempfile
+import polars as pl
+from pathlib import Path
+
+from src.lib.Catalog import build_catalog
+from src.lib.common import Int3
+from src.lib.Config import General, Structure
+from src.lib.control.common import TempRange, temp_config
+from src.lib.Materials import BTO
+from src.lib.Operations import Archive, DirIn, FileOut, ParallelGzipWriter
+
+'''run with python -m src.lib.Test_Archive, or pytest src/lib/Test_Archive.py'''
+
+BLOCK_SIZE = 4 * 2**20  # default of ParallelGzipWriter
+
+
+def run_files(run_dir: Path) -> dict[str, bytes]:
+    '''A run directory of more than two gzip blocks: incompressible and compressible files.'''
+    files = {
+        'thermo.avg':        b''.join(b'%d 1.000000 -0.500000\n' % i for i in range(300_000)),
+        'coords/350.coord':  os.urandom(BLOCK_SIZE + 12345),
+        '_artifacts/x.bin':  os.urandom(1000),
+    }
+    for name, data in files.items():
+        (run_dir / name).parent.mkdir(parents=True, exist_ok=True)
+        (run_dir / name).write_bytes(data)
+    return files
+
+def members(tar: tarfile.TarFile) -> dict[str, bytes]:
+    return {Path(*Path(m.name).parts[1:]).as_posix(): tar.extractfile(m).read() for m in tar if m.isfile()}
+
+
+def test_parallel_gzip_roundtrip():
+    data = os.urandom(BLOCK_SIZE // 2) + b'feram\n' * (BLOCK_SIZE // 3)
+
+    for size in (0, 1, BLOCK_SIZE, 2 * BLOCK_SIZE + 7):
+        buffer = io.BytesIO()
+        with ParallelGzipWriter(buffer, max_workers=3) as gz:
+            for start in range(0, size, 1 << 20):
+                gz.write((data * 3)[start:min(start + (1 << 20), size)])
+
+        assert gzip.decompress(buffer.getvalue()) == (data * 3)[:size]
+
+def test_archive_roundtrip():
+    with tempfile.TemporaryDirectory() as tmp:
+        run_dir = Path(tmp) / 'run'
+        archive = Path(tmp) / 'run.tar.gz'
+        files   = run_files(run_dir)
+
+        assert Archive(DirIn(run_dir), FileOut(archive), max_workers=4).run().is_ok()
+        assert archive.stat().st_size > BLOCK_SIZE
+
+        for mode in ('r:gz', 'r|gz'):  # random access and stream
+            with tarfile.open(archive, mode) as tar:
+                assert members(tar) == files
+
+def test_catalog_of_archives():
+    '''Runs archived in more than one gzip block, by Archive and as several gzip members (as before); a truncated one is skipped.'''
+    config = temp_config(material=BTO, temp_range=TempRange(350, 340, -5),
+                         setup=[General(L=Int3(3, 3, 2), bulk_or_film=Structure.Film)])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root, cache = Path(tmp) / 'output', Path(tmp) / 'cache'
+        run_dir     = Path(tmp) / 'run'
+        run_files(run_dir)
+        (run_dir / 'thermo.avg').unlink()  # kelvins from coords/
+        (run_dir / 'bto.feram').write_text(config.config.generate_feram_file())
+        pl.DataFrame({'kelvin': [350.0]}).write_parquet(run_dir / '_artifacts' / 'bto.parquet')
+
+        root.mkdir()
+        assert Archive(DirIn(run_dir), FileOut(root / 'single.tar.gz')).run().is_ok()
+        assert (root / 'single.tar.gz').stat().st_size > BLOCK_SIZE
+
+        tar_bytes = io.BytesIO()
+        with tarfile.open(fileobj=tar_bytes, mode='w') as tar:
+            tar.add(run_dir, arcname='run')
+        blocks = [tar_bytes.getvalue()[i:i + BLOCK_SIZE] for i in range(0, len(tar_bytes.getvalue()), BLOCK_SIZE)]
+        (root / 'members.tar.gz').write_bytes(b''.join(map(gzip.compress, blocks)))
+
+        single = (root / 'single.tar.gz').read_bytes()
+        (root / 'truncated.tar.gz').write_bytes(single[:len(single) // 2])
+
+        catalog = build_catalog(root, archives=True, index=cache / 'catalog.parquet')
+        runs    = catalog.runs().sort('run')
+
+        assert runs['run'].to_list() == ['members', 'single']
+        assert runs['material'].to_list() == ['BTO', 'BTO'] and runs['structure'].to_list() == ['film', 'film']
+        assert runs['kelvins'].to_list() == [[350.0], [350.0]]
+        assert catalog.scan().collect()['kelvin'].to_list() == [350.0, 350.0]
+
+
+if __name__ == '__main__':
+    for test in [value for name, value in list(globals().items()) if name.startswith('test_')]:
+        test()
+    print('clear. everything is fine.')
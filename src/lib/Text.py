@@ -0,0 +1,65 @@
+'''
+Vectorized text encoding of tables, for the large whitespace separated files feram reads and writes.
+
+Every column of a table is given as (indices, strings): row i shows strings[indices[i]].
+Columns only take few distinct values (lattice coordinates, domain props, ...), so the strings are
+formatted once in Python, exactly as an f-string would, and rows are assembled as bytes in NumPy.
+'''
+
+import numpy as np
+from numpy.typing import NDArray
+from collections.abc import Iterator, Sequence
+from typing import NamedTuple, Optional
+
+
+Column = tuple[NDArray[np.integer], Sequence[str]]
+
+CHUNK_ROWS = 2**18
+
+
+class Table(NamedTuple):
+    columns: Sequence[Column]
+    array: Optional[NDArray] = None  # the same rows as numbers (structured), cached as a binary twin of the text, see WriteTable
+
+
+def string_column(values: NDArray) -> Column:
+    '''values as a column, formatted like f'{value}' of the equivalent Python int/float.'''
+    distinct, indices = np.unique(values, return_inverse=True)
+    return indices.ravel(), [str(v) for v in distinct.tolist()]
+
+def int_column(values: NDArray[np.integer]) -> Column:
+    '''Like string_column, without sorting: for integers of a small range, e.g. lattice coordinates.'''
+    if len(values) == 0:
+        return values, []
+    low, high = int(values.min()), int(values.max())
+    return values - low, [str(v) for v in range(low, high + 1)]
+
+
+def encode_rows(columns: Sequence[Column], sep: str = ' ') -> bytes:
+    '''Rows of columns joined by sep, lines joined by '\\n' (no trailing newline), like
+    '\\n'.join(sep.join(...) for row in rows).'''
+    if not columns or len(columns[0][0]) == 0:
+        return b''
+
+    # one token table for all columns: each token carries the separator that follows it
+    tokens  = [s.encode() + (sep.encode() if c < len(columns) - 1 else b'\n')
+               for c, (_, strings) in enumerate(columns)
+               for s in strings]
+    bases   = np.cumsum([0] + [len(strings) for _, strings in columns[:-1]])
+    lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+    starts  = np.cumsum(lengths) - lengths
+    blob    = np.frombuffer(b''.join(tokens), dtype=np.uint8)
+
+    ids     = np.stack([base + np.asarray(indices) for base, (indices, _) in zip(bases, columns)], axis=1).ravel()
+    size    = lengths[ids]
+    offsets = np.cumsum(size) - size
+    gather  = np.repeat(starts[ids] - offsets, size) + np.arange(offsets[-1] + size[-1])
+
+    return blob[gather][:-1].tobytes()
+
+def encode_chunks(columns: Sequence[Column], sep: str = ' ', chunk_rows: int = CHUNK_ROWS) -> Iterator[bytes]:
+    '''encode_rows of chunk_rows rows at a time; the chunks are to be joined by '\\n'.'''
+    n_rows = len(columns[0][0]) if columns else 0
+
+    for start in range(0, n_rows, chunk_rows):
+        yield encode_rows([(indices[start:start + chunk_rows], strings) for indices, strings in columns], sep)
@@ -0,0 +1,134 @@
+'''
+All lattice frames of a run (.coord, .dipoRavg) in one file.
+
+The file is a zip (readable by np.load as .npz) with one compressed member per frame, {kind}/{index}.npy,
+holding the frame on the lattice as [z, y, x, component], and metadata.json describing every frame.
+Reading a frame only decompresses its own member.
+'''
+
+import json
+import zipfile
+import numpy as np
+import polars as pl
+from dataclasses import asdict
+from pathlib import Path
+from collections.abc import Callable, Iterable, Sequence
+from typing import Any, NamedTuple, Optional, Self
+from numpy.typing import NDArray
+
+from src.lib.Config import FeramConfig
+from src.lib.Coord import COORD_COLUMNS, DIPO_COLUMNS, load_frame
+from src.lib.Operations import *
+
+
+KIND_COLUMNS = {
+    'coord':    COORD_COLUMNS,
+    'dipoRavg': DIPO_COLUMNS,
+}
+
+class FrameInfo(NamedTuple):
+    kind: str                     # coord, dipoRavg
+    stage: str                    # e.g. temperature, or the step directory of ECE
+    temperature: float            # [K]
+    time_step: Optional[int]      # None: averaged over the stage
+    source: str = ''              # file the frame was read from
+
+
+def config_metadata(config: FeramConfig) -> dict[str, Any]:
+    return json.loads(json.dumps(asdict(config), default=str))
+
+
+def write_trajectory(path: Path, frames: Iterable[tuple[Path, FrameInfo]], metadata: dict[str, Any],
+                     compresslevel: int = 6) -> int:
+    '''Returns the number of frames written.'''
+    tmp    = path.with_name(f'{path.name}.tmp')
+    infos  = []
+    counts = dict.fromkeys(KIND_COLUMNS, 0)
+
+    with zipfile.ZipFile(tmp, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as store:
+        for frame_path, info in frames:
+            frame  = load_frame(frame_path, None, KIND_COLUMNS[info.kind])
+            member = f'{info.kind}/{counts[info.kind]:06d}.npy'
+
+            with store.open(member, 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, frame.grids())
+            counts[info.kind] += 1
+            infos.append(info._replace(source=info.source or frame_path.name))
+
+        store.writestr('metadata.json', json.dumps({
+            'columns': {kind: list(columns) for kind, columns in KIND_COLUMNS.items()},
+            'frames':  [info._asdict() for info in infos],
+            **metadata,
+        }, indent=2))
+
+    tmp.replace(path)
+    return len(infos)
+
+
+class Trajectory:
+    '''Read a file written by write_trajectory.
+
+    trajectory = Trajectory.open(path)
+    trajectory.index                       # polars frame: FrameInfo and index of every frame
+    trajectory.frame('coord', 3)           # [z, y, x, component], only this frame is read
+    trajectory.frames('dipoRavg')          # [frame, z, y, x, component]'''
+    def __init__(self, store: zipfile.ZipFile):
+        self.store    = store
+        self.metadata = json.loads(store.read('metadata.json'))
+        self.infos    = [FrameInfo(**info) for info in self.metadata['frames']]
+
+    @classmethod
+    def open(cls, path: Path) -> Self:
+        return cls(zipfile.ZipFile(path))
+
+    def close(self):
+        self.store.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def columns(self, kind: str) -> list[str]:
+        return self.metadata['columns'][kind]
+
+    def infos_of(self, kind: str) -> list[FrameInfo]:
+        return [info for info in self.infos if info.kind == kind]
+
+    @property
+    def index(self) -> pl.DataFrame:
+        return pl.DataFrame([
+            {**info._asdict(), 'index': i}
+            for kind in self.metadata['columns']
+            for i, info in enumerate(self.infos_of(kind))
+        ], schema_overrides={'time_step': pl.Int64})
+
+    def frame(self, kind: str, index: int) -> NDArray[np.float64]:
+        with self.store.open(f'{kind}/{index:06d}.npy') as f:
+            return np.lib.format.read_array(f)
+
+    def frames(self, kind: str, indices: Optional[Sequence[int]] = None) -> NDArray[np.float64]:
+        indices = range(len(self.infos_of(kind))) if indices is None else indices
+        return np.stack([self.frame(kind, i) for i in indices])
+
+
+class WriteTrajectory(Operation):
+    '''Pack the frames returned by get_frames into output_file, see write_trajectory.
+    metadata: stored along, e.g. config_metadata of the run's FeramConfig'''
+    def __init__(self, output_file: FileOut, get_frames: Callable[[], Iterable[tuple[Path, FrameInfo]]],
+                 metadata: Optional[dict[str, Any]] = None):
+        super().__init__(lambda: self.do(output_file, get_frames, metadata or {}))
+
+    @as_result(Exception)
+    def safe_write(self, file: FileOut, get_frames: Callable[[], Iterable[tuple[Path, FrameInfo]]],
+                   metadata: dict[str, Any]) -> int:
+        return write_trajectory(file.path, get_frames(), metadata)
+
+    def do(self, output_file: FileOut, get_frames: Callable[[], Iterable[tuple[Path, FrameInfo]]],
+           metadata: dict[str, Any]) -> OperationR:
+        return do(
+            Ok(n)
+            for checked_out in output_file.check_preconditions()
+            for n in self.safe_write(checked_out, get_frames, metadata)
+        ).map(lambda n: f'{type(self).__name__}: {output_file.path} ({n} frames)').map_err(lambda x: f'{type(self).__name__}: {x}')
@@ -1,13 +1,15 @@
 import argparse
+import hashlib
 import types
 import colors
 import datetime
 import shutil as sh
 import inspect
 import sys
+import threading
 from pathlib import Path
 from result import Result, Ok, Err
-from typing import cast
+from typing import Optional, cast
 from collections.abc import Iterable
 
 
@@ -17,21 +19,33 @@ def feram_with_fallback(fallback: Path = Path.cwd()) -> Path:
 
     return Path(which) if which else fallback
 
+def cmd_line_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='AutoFeram')
+    parser.add_argument('-f', '--feram-bin')
+    parser.add_argument('--resume', type=Path, metavar='OUTPUT_DIR', help='continue the interrupted run in OUTPUT_DIR')
+    return parser.parse_args()
+
 def feram_bin_from_cmd_line():
     '''Use the feram executable provided by the command-line argument.
     Otherwise use the executable in $PATH.'''
-    parser = argparse.ArgumentParser(prog='AutoFeram')
-    parser.add_argument('-f', '--feram-bin')
-    feram_bin_arg = parser.parse_args().feram_bin
+    feram_bin_arg = cmd_line_args().feram_bin
 
     if feram_bin_arg:
         return Path(feram_bin_arg)
     elif feram_bin_which := sh.which('feram'):
         return Path(feram_bin_which)
 
+def resume_from_cmd_line() -> Optional[Path]:
+    '''Output directory of the run to resume (--resume), None: start a new run.'''
+    return cmd_line_args().resume
+
 def project_root() -> Path:
     return Path(__file__).parent.parent.parent
 
+def cache_root() -> Path:
+    '''Data kept across runs, e.g. probed feram capabilities.'''
+    return project_root() / '.cache'
+
 def src_root() -> Path:
     return Path(__file__).parent.parent
 
@@ -44,14 +58,17 @@ def function_name():
                 cast(types.FrameType,
                      inspect.currentframe()).f_back).f_code.co_name
 
+print_lock = threading.Lock()  # operations may run concurrently
+
 def print_result(result: Result, color_ok='green', color_err='red', color_body='dimgray', text_ok='Success') -> None:
-    match result:
-        case Ok(value):
-            print(f"{colors.color(text_ok, color_ok)}\t {colors.color(value, color_body)}")
-        case Err(e):
-            msg = f"{colors.color('Failure', color_err)}\t {colors.color(e, color_body)}"
-            print(msg)
-            print(msg, file=sys.stderr)
+    with print_lock:
+        match result:
+            case Ok(value):
+                print(f"{colors.color(text_ok, color_ok)}\t {colors.color(value, color_body)}")
+            case Err(e):
+                msg = f"{colors.color('Failure', color_err)}\t {colors.color(e, color_body)}"
+                print(msg)
+                print(msg, file=sys.stderr)
 
 def exit_from_result(result: Result):
     match result:
@@ -63,5 +80,17 @@ def exit_from_result(result: Result):
 def timestamp(format = '%Y-%m-%d'):
     return datetime.datetime.now().strftime(format)
 
+def content_key(*parts) -> str:
+    '''Key identifying whatever is generated from parts, across runs.
+    parts must have a stable repr, or be arrays (hashed by content).'''
+    digest = hashlib.sha256()
+    for part in parts:
+        if hasattr(part, 'tobytes'):
+            digest.update(f'{part.dtype}{part.shape}'.encode())
+            digest.update(part.tobytes())
+        else:
+            digest.update(repr(part).encode())
+    return digest.hexdigest()[:32]
+
 def inclusive_range(a: int, b: int) -> Iterable[int]:
     return range(min(a, b), max(a, b) + 1, 1)
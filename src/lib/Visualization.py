@@ -13,9 +13,15 @@ import matplotlib.cm as cm
 from matplotlib.ticker import NullFormatter
 # import src.lib.materials
 import pickle
+from pathlib import Path
 
 from src.lib.Config import *
 from src.lib.Config import *
+from src.lib.Coord import COORD_COLUMNS, DIPO_COLUMNS, load_frame
+from src.lib.Log import read_log_columnar
+from src.lib.Phase import determine_phases
+from src.lib.Schema import AVG_SCHEMA, HL_SCHEMA
+from src.lib.Tables import polarization, scan_table, table_to_pandas
 from src.lib.materials.BTO import BTO
 
 markers = ['o', '*', '<', '3', 'v', '^', '>', '1', '2', '4', '8', 's', 'p', 'P', 'h', 'H', '+', 'x', 'X', 'D']
@@ -63,56 +69,37 @@ def determine_phase(Px, Py, Pz, zero_noise=0.5):
 
 ### file post processing
 def get_avg(path, material_config):
-    with open(f'{path}', 'r') as inf:
-        df = pd.read_table(inf, sep=r'\s+', header=None,\
-                           names=['kelvin', 'Ex', 'Ey', 'Ez', 's_xx', 's_yy', 's_zz', 's_yz', 's_xz', 's_xy',\
-                                  'u1', 'u2', 'u3', 'uu1', 'uu2', 'uu3', 'uu4', 'uu5', 'uu6',\
-                                  'e_dipo_kinetic', 'e_long_range', 'e_dipole_E_field', 'e_unharmonic', 'e_homo_strain', 'e_homo_coupling', 'e_inho_strain', 'e_inho_coupling', 'e_total', 'e_Nose_Poincare', 'e2', 'dipo_kinetic_true', 'e_acou_kinetic', 'e_short_range', 'e_inho_modulation',\
-                                  'p1', 'p2', 'p3', 'pp1', 'pp2', 'pp3', 'pp4', 'pp5', 'pp6'])
     factor = material_config.polarization_parameters()
-    df['px'] = df['u1'] * factor
-    df['py'] = df['u2'] * factor
-    df['pz'] = df['u3'] * factor
-    df['p_total'] = np.sqrt(df['px']**2 + df['py']**2 + df['pz']**2)
-    df['phase'] = [ determine_phase(px, py, pz) for (px, py, pz) in zip(df['px'], df['py'], df['pz']) ] 
+    df = table_to_pandas(scan_table(Path(path), AVG_SCHEMA).with_columns(polarization(factor)).collect())
+    df['phase'] = determine_phases(df[['px', 'py', 'pz']].to_numpy())
 
     # df.to_csv(f"{path}/{save_as}.csv")
     return df
 
 def get_hl(path, material_config):
-    with open(f'{path}', 'r') as inf:
-        df = pd.read_table(inf, sep=r'\s+', header=None,\
-                           names=['step', 'kelvin', 'Ex', 'Ey', 'Ez', 's_xx', 's_yy', 's_zz', 's_yz', 's_xz', 's_xy',\
-                                  'u1', 'u2', 'u3', '_', '_', '_', '_', '_', '_',\
-                                  'e_dipo_kinetic', 'e_short_range', 'e_long_range', 'e_dipole_E_field', 'e_unharmonic', 'e_homo_strain', 'e_homo_coupling', 'e_inho_strain', 'e_inho_coupling', 'e_inho_modulation', 'e_total', 'e_Nose_Poincare', 'e2', 'dipo_kinetic_true', 'e_acou_kinetic'])
     factor = material_config.polarization_parameters()
-    df['px'] = df['u1'] * factor
-    df['py'] = df['u2'] * factor
-    df['pz'] = df['u3'] * factor
-    df['p_total'] = np.sqrt(df['px']**2 + df['py']**2 + df['pz']**2)
+    df = table_to_pandas(scan_table(Path(path), HL_SCHEMA).with_columns(polarization(factor)).collect())
         # df.to_csv(f'{path}/{name}_hl.txt')
     return df
 
 def get_coord(path, material_config):
-    with open(f'{path}', 'r') as inf:
-        df = pd.read_table(inf, sep=r'\s+', header=None,\
-                           names=['x', 'y', 'z', 'u1', 'u2', 'u3',\
-                                  'dipoP1', 'dipoP2', 'dipoP3',\
-                                  'dVddi1', 'dVddi2', 'dVddi3',\
-                                  'acouR1', 'acouR2', 'acouR3',\
-                                  'acouP1', 'acouP2', 'acouP3'])
+    df = load_frame(Path(path), COORD_COLUMNS).to_pandas().rename(columns=dict(zip(COORD_COLUMNS,
+                         ['u1', 'u2', 'u3',\
+                          'dipoP1', 'dipoP2', 'dipoP3',\
+                          'dVddi1', 'dVddi2', 'dVddi3',\
+                          'acouR1', 'acouR2', 'acouR3',\
+                          'acouP1', 'acouP2', 'acouP3'])))
     factor = material_config.polarization_parameters()
     df['px'] = df['u1'] * factor
     df['py'] = df['u2'] * factor
     df['pz'] = df['u3'] * factor
     df['p_total'] = np.sqrt(df['px']**2 + df['py']**2 + df['pz']**2)
+    df['phase'] = determine_phases(df[['px', 'py', 'pz']].to_numpy())
 #     df.to_csv(f"{path}/{name}_hl.csv")
     return df
 
 def get_dipoRavg(path, material_config):
-    with open(f'{path}', 'r') as inf:
-        df = pd.read_table(inf, sep=r'\s+', header=None,\
-                           names=['x', 'y', 'z', 'u1', 'u2', 'u3'])
+    df = load_frame(Path(path), DIPO_COLUMNS).to_pandas().rename(columns=dict(zip(DIPO_COLUMNS, ['u1', 'u2', 'u3'])))
     factor = material_config.polarization_parameters()
     df['px'] = df['u1'] * factor
     df['py'] = df['u2'] * factor
@@ -137,51 +124,37 @@ def get_properties_from_txt(file):
 
 
 def evolution(config: FeramConfig, path, name, zstar, firsttime=False,inittime=-160):
-    factor = config.polarization_parameters()['factor']
-
-    if firsttime == True and os.path.exists(f'{path}/{name}.log'):
-        shell(f"grep -a '<u>' {path}/{name}.log | awk '{{print $3 \"\\t\" $4 \"\\t\" $5}}' > {path}/displacement_u.txt")
-        shell(f"grep -a total_energy {path}/{name}.log | awk '{{print $2}}' > {path}/total_energy.txt")
-        shell(f"grep -a dipo_kinetic {path}/{name}.log | awk '{{print $2}}' > {path}/dipo_kinetic.txt")
-
-    df_u    = pd.read_csv(f'{path}/displacement_u.txt', sep="\t", header=None, names=['px', 'py', 'pz'],index_col=False)
-    df_p    = df_u * factor
-    df_Etot = pd.read_csv(f'{path}/total_energy.txt',header=None, names=['Etot'],index_col=False)
-    df_Edk  = pd.read_csv(f'{path}/dipo_kinetic.txt',header=None, names=['Edk'],index_col=False)
-    df_T    = df_Edk.rename(columns={'Edk': 'kelvin'}) / (1.5*8.617E-5)
-    df_0    = df_Etot.merge(df_Edk, left_index=True,right_index=True)
-    df      = df_0.merge(df_T, left_index=True,right_index=True)
-    # df_Etot = pd.DataFrame(Etot, columns =['total_energy'])
-    # df_Edk = pd.DataFrame(Edk, columns =['dipo_kinetic'])
-
-    timestep = shell(f"grep dt {path}/{name}.feram  | awk '{{print $3}}'")
+    '''Time evolution of {path}/{name}.log, in one pass over the log. firsttime: unused, no intermediate files are written.'''
+    factor   = config.polarization_parameters.factor
+    log      = read_log_columnar(Path(path) / f'{name}.log').to_numpy()
+    timestep = float(read_feram_file(Path(path) / f'{name}.feram')['dt'])
 
     if name == 'preNPT':
         initial_time = inittime #-160
-        initial_time_u = inittime #-160 #-40
 
     elif name == 'preNPE':
         initial_time = 0
-        initial_time_u = 0 #80
 
     elif name == 'rampNPE':
         print('Please use another function: evolution_ramping')
 
     elif name == 'postNPE':
         initial_time = 220
-        initial_time_u = 220 #300
 
     else:
         initial_time = -10000000
-        initial_time_u = -10000000
-
-    df.insert(0, "time_ps", [round(i * float(timestep) + initial_time,3) for i in list(range(0,len(df)))])
-    df = df[:-1]
 
-    df_p.insert(0, "time_ps", [round(i * float(timestep) + initial_time_u,3) for i in list(range(0,len(df_p)))])
-    df_final = df.merge(df_p, on="time_ps", how = 'outer')
+    p = log['u'] * factor
 
-    return df_final
+    return pd.DataFrame({
+        'time_ps': np.round(np.arange(len(p)) * timestep + initial_time, 3),
+        'Etot':    log['total_energy'],
+        'Edk':     log['dipo_kinetic'],
+        'kelvin':  log['dipo_kinetic'] / (1.5*8.617E-5),
+        'px':      p[:, 0],
+        'py':      p[:, 1],
+        'pz':      p[:, 2],
+    })
 
 # def evolution_ramping(path, name, zstar, firsttime=False,inittime=-160):
 #     factor=get_factor(zstar)
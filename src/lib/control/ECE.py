@@ -1,79 +1,140 @@
+import functools
 from pathlib import Path
 from itertools import zip_longest
+from typing import Callable, Optional
 
+from src.lib.Cache import Policy
 from src.lib.common import *
 from src.lib.control.common import *
 from src.lib.Config import *
 from src.lib.Domain import *
+from src.lib.Journal import Journal, Journaled, OpenJournal, Step
 from src.lib.Materials import BTO
 from src.lib.Operations import *
 from src.lib.Ovito import WriteOvito
+from src.lib.Statistics import WriteStatistics
+from src.lib.Trajectory import FrameInfo, WriteTrajectory, config_metadata
 from src.lib.Util import *
 
 
-def run(runner: Runner, ece_config: ECEConfig, add_pre: Operation = Empty()) -> OperationR:
+def run(runner: Runner, ece_config: ECEConfig, add_pre: Operation = Empty(), resume: bool = False,
+        cache: Optional[Policy] = None) -> OperationR:
+    '''resume: continue an interrupted run in runner.output_dir from its first incomplete step, see Journal.
+    cache:  run cache of the feram runs (see Operations.Feram), None: every step is run.'''
     sim_name, output_dir, feram_bin = runner
+    journal                         = Journal(output_dir)  # opened after pre
 
-    src_file      = caller_src_path()
-    artifacts_dir = output_dir / '_artifacts'
-    ovito_dir     = artifacts_dir / 'ovito'
-    af_src_file   = artifacts_dir / f'AutoFeram_{src_file.name}'
-    parquet_file  = artifacts_dir / f'{sim_name}.parquet'
+    src_file        = caller_src_path()
+    artifacts_dir   = output_dir / '_artifacts'
+    ovito_dir       = artifacts_dir / 'ovito'
+    af_src_file     = artifacts_dir / f'AutoFeram_{src_file.name}'
+    parquet_file    = artifacts_dir / f'{sim_name}.parquet'
+    stats_file      = artifacts_dir / f'{sim_name}.stats.parquet'
+    trajectory_file = artifacts_dir / f'{sim_name}.trajectory.npz'
 
     pre = OperationSequence([
         Message('Pre'),
-        MkDirs(DirOut(output_dir, preconditions=[dir_doesnt_exist])),
+        MkDirs(DirOut(output_dir, preconditions=[] if resume else [dir_doesnt_exist])),
         MkDirs(DirOut(artifacts_dir)),
         MkDirs(DirOut(ovito_dir)),
         *[MkDirs(DirOut(output_dir / step_dir)) for step_dir in ece_config.steps.keys()],
         add_pre
     ])
 
-    def step(config: FeramConfig | Any, dir_cur: Path | Any, dir_next: Path | Any) -> OperationSequence:
-        feram_file      = dir_cur / f'{sim_name}.feram'
+    def feram_step(step_dir: str, config: FeramConfig, prev_step_dir: Optional[str]) -> Step:
+        dir_cur    = output_dir / step_dir
+        feram_file = dir_cur / f'{sim_name}.feram'
+
+        return Step(
+            name      = step_dir,
+            operation = OperationSequence([
+                            Message(dir_cur.name),
+                            Write(FileOut(feram_file), config.generate_feram_file),
+                            Feram(Exec(feram_bin), FileIn(feram_file), cache=cache)
+                        ]),
+            outputs   = [dir_cur / f'{sim_name}.{config.last_coord}.coord', dir_cur / f'{sim_name}.json'],
+            restart   = dir_cur / f'{sim_name}.restart' if prev_step_dir else None
+        )
+
+    def step(step_dir: str, config: FeramConfig, prev_step_dir: Optional[str], next_step_dir: Optional[str],
+             done: Callable[[], bool]) -> dict[str, Node]:
+        dir_cur         = output_dir / step_dir
         last_coord_file = dir_cur / f'{sim_name}.{config.last_coord}.coord'
-        copy_restart    = Copy(FileIn(last_coord_file),
-                               FileOut(dir_next / f'{sim_name}.restart')) if dir_next is not Any else Empty()
-
-        return OperationSequence([
-            Message(dir_cur.name),
-            Write(FileOut(feram_file), config.generate_feram_file),
-            WithDir(DirIn(output_dir), DirIn(dir_cur),
-                    Feram(Exec(feram_bin), FileIn(feram_file))),
-            copy_restart,
-            WriteOvito(DirIn(dir_cur), FileOut(ovito_dir / f'coords_{dir_cur.name}.ovt'), 'coord'),
-            WriteOvito(DirIn(dir_cur), FileOut(ovito_dir / f'dipoRavgs_{dir_cur.name}.ovt'), 'dipoRavg')
-        ])
-
-    steps    = [(output_dir / step_dir, setup) for step_dir, setup in ece_config.steps.items()]
-    step_zip = zip_longest(steps, steps[1:], fillvalue=(Any, Any))
-
-    main = OperationSequence(
-        step(setup, dir_cur, dir_next)
-        for (dir_cur, setup), (dir_next, _) in step_zip
-    )
+        journal_step    = feram_step(step_dir, config, prev_step_dir)
+        copy_restart    = {
+            f'{step_dir}/restart': Node(Copy(FileIn(last_coord_file), FileOut(output_dir / next_step_dir / f'{sim_name}.restart')),
+                                        after = [f'{step_dir}/feram'])
+        } if next_step_dir else {}
+
+        return {
+            f'{step_dir}/feram':     Node(Lazy(lambda: Message(f'{step_dir}: completed') if done() else Journaled(journal, journal_step)),
+                                          after = [f'{prev_step_dir}/restart'] if prev_step_dir else []),
+            **copy_restart,
+            f'{step_dir}/coords':    Node(WriteOvito(DirIn(dir_cur), FileOut(ovito_dir / f'coords_{dir_cur.name}.ovt'), 'coord'),
+                                          after = [f'{step_dir}/feram']),
+            f'{step_dir}/dipoRavgs': Node(WriteOvito(DirIn(dir_cur), FileOut(ovito_dir / f'dipoRavgs_{dir_cur.name}.ovt'), 'dipoRavg'),
+                                          after = [f'{step_dir}/feram']),
+        }
+
+    # each step restarts from the last .coord of the previous one; everything else only waits for what it reads
+    step_dirs  = list(ece_config.steps.keys())
+    step_zip   = list(zip_longest([None, *step_dirs], step_dirs, step_dirs[1:]))
+    # once the journal is open, before the first step runs (the steps run in order)
+    completed  = functools.cache(lambda: journal.completed([feram_step(step_dir, ece_config.steps[step_dir], prev_step_dir)
+                                                            for prev_step_dir, step_dir, _ in step_zip if step_dir]))
+    step_nodes = {
+        name: node
+        for i, (prev_step_dir, step_dir, next_step_dir) in enumerate(step_zip) if step_dir
+        for name, node in step(step_dir, ece_config.steps[step_dir], prev_step_dir, next_step_dir,
+                               lambda i=i: i < completed()).items()
+    }
 
-    post = OperationSequence([
-        Message('Post'),
-        Copy(FileIn(src_file), FileOut(af_src_file)),
-        WriteParquet(FileOut(parquet_file), lambda: post_process_ece(runner, ece_config)),
-        Archive(DirIn(output_dir), FileOut(project_root() / 'output' / f'{output_dir.name}.tar.gz'))
-    ])
+    def trajectory_frames() -> list[tuple[Path, FrameInfo]]:
+        def step_frames(step_dir: str, config: FeramConfig) -> list[tuple[Path, FrameInfo]]:
+            kelvin = config.setup['kelvin']
+            coords = sorted(output_dir.glob(f'{step_dir}/{sim_name}.*.coord'))
+            return [
+                *((coord, FrameInfo('coord', step_dir, kelvin, int(coord.suffixes[-2][1:]))) for coord in coords),
+                (output_dir / step_dir / f'{sim_name}.dipoRavg', FrameInfo('dipoRavg', step_dir, kelvin, None)),
+            ]
+
+        return [frame for step_dir, config in ece_config.steps.items() for frame in step_frames(step_dir, config)]
+
+    main_post = OperationGraph({
+        **step_nodes,
+        'source':     Node(Copy(FileIn(src_file), FileOut(af_src_file))),
+        'parquet':    Node(WriteParquet(FileOut(parquet_file), lambda: post_process_ece(runner, ece_config)),
+                           after = [f'{step_dir}/feram' for step_dir in step_dirs]),
+        'trajectory': Node(WriteTrajectory(FileOut(trajectory_file), trajectory_frames,
+                                           {'sim_name': sim_name,
+                                            'steps': {step_dir: config_metadata(config) for step_dir, config in ece_config.steps.items()}}),
+                           after = [f'{step_dir}/feram' for step_dir in step_dirs]),
+        'stats':      Node(WriteStatistics(FileOut(stats_file), trajectory_frames,
+                                           ece_config.steps[step_dirs[0]].polarization_parameters.factor),  # same material in every step
+                           after = [f'{step_dir}/feram' for step_dir in step_dirs]),
+        # left out: the trajectory, which repeats the frames of the run and is rebuilt from them by WriteTrajectory,
+        # and the journal, which is only there to resume the run
+        'archive':    Node(Archive(DirIn(output_dir), FileOut(project_root() / 'output' / f'{output_dir.name}.tar.gz'),
+                                   exclude = lambda path: path in (trajectory_file, journal.path, journal.start_file)),
+                           after = [*step_nodes, 'source', 'parquet', 'trajectory', 'stats']),
+    })
 
     return OperationSequence([
         pre,
         Message('Main'),
-        main,
-        post,
+        OpenJournal(journal, resume),
+        main_post,
         Success(src_file.name)
     ]).run()
 
 
 if __name__ == "__main__":
+    resume_dir = resume_from_cmd_line()
+
     runner = Runner(
         sim_name    = 'bto',
         feram_path  = Path.home() / 'feram_dev/build/src/feram',
-        output_dir  = project_root() / 'output' / f'ece_{timestamp()}'
+        output_dir  = resume_dir or project_root() / 'output' / f'ece_{timestamp()}'
     )
 
     efield_initial = Vec3(0.0007071067811865476, 0.0007071067811865475 ,6.123233995736766e-20)
@@ -132,4 +193,4 @@ if __name__ == "__main__":
             ]
         })
 
-    exit_from_result(run(runner, config))
+    exit_from_result(run(runner, config, resume = resume_dir is not None))
@@ -4,7 +4,7 @@ from src.lib.common import Int3
 from src.lib.control import Temperature
 from src.lib.control.common import Runner, TempRange, temp_config
 from src.lib.Config import General, Structure
-from src.lib.Domain import Domain, LocalfieldWriter, RegionalLocalfieldWriter, Props
+from src.lib.Domain import Domain, LocalfieldWriter, RegionalLocalfieldWriter, Props, periodic_axes
 from src.lib.Materials import BTO
 from src.lib.Util import exit_from_result, feram_with_fallback, project_root, timestamp
 
@@ -44,7 +44,8 @@ if __name__ == "__main__":
     #                Domain(Int3(1, 0, 0), Props(0, 1, 0)),
     #                # Domain(Int3(12, 47, 0), Props(1, 0, 0)),
     #                # Domain(Int3(24, 24, 0), Props(0, -1, 0)),
-    #                ]
+    #                ],
+    #     periodic = periodic_axes(config.config.setup['bulk_or_film'])
     # )
     #
 
@@ -53,7 +54,9 @@ if __name__ == "__main__":
         output_path = runner.output_dir / f'{runner.sim_name}.localfield',
         domains = [Domain(Int3(10, 10, 10), Props(0, 0.1, 0), delta = Int3(-2,2,0)),
                    Domain(Int3(2, 2, 2), Props(0, 0.2, 0), delta = Int3(-2,2,0))
-                   ]
+                   ],
+        size     = config.config.setup['L'],
+        periodic = periodic_axes(config.config.setup['bulk_or_film'])
     )
 
     exit_from_result(Temperature.run(runner, config, add_pre = lf_writer))
@@ -1,25 +1,38 @@
+import os
 from copy import deepcopy
 from pathlib import Path
+from collections.abc import Sequence
+from typing import Optional
 
+from src.lib.Cache import Policy
 from src.lib.common import *
 from src.lib.control.common import *
 from src.lib.Config import *
+from src.lib.Journal import Journal, OpenJournal, Step, resume_steps
 from src.lib.Materials import BTO
 from src.lib.Operations import *
 from src.lib.Ovito import WriteOvito
+from src.lib.Statistics import WriteStatistics
+from src.lib.Trajectory import FrameInfo, WriteTrajectory, config_metadata
 from src.lib.Util import *
 
 
-def run(runner: Runner, temp_config: TempConfig, add_pre: Operation = Empty()) -> OperationR:
+def run(runner: Runner, temp_config: TempConfig, add_pre: Operation = Empty(), pool: SweepPool = SweepPool(),
+        resume: bool = False, cache: Optional[Policy] = None) -> OperationR:
+    '''resume: continue an interrupted run in runner.output_dir from its first incomplete temperature, see Journal.
+    cache:  run cache of the feram runs (see Operations.Feram), None: every temperature is run.'''
     sim_name, output_dir, feram_bin = runner
     _, temps, config                = temp_config
+    journal                         = Journal(output_dir)  # opened after pre
 
     src_file        = caller_src_path()
     feram_file      = output_dir / f'{sim_name}.feram'
     avg_file        = output_dir / f'{sim_name}.avg'
+    json_file       = output_dir / f'{sim_name}.json'
     thermo_file     = output_dir / 'thermo.avg'
     coord_dir       = output_dir / 'coords'
     dipoRavg_dir    = output_dir / 'dipoRavg'
+    chains_dir      = output_dir / 'chains'
     dipoRavg_file   = output_dir / f'{sim_name}.dipoRavg'
     last_coord_file = output_dir / f'{sim_name}.{config.last_coord}.coord'
     restart_file    = output_dir / f'{sim_name}.restart'
@@ -28,6 +41,8 @@ def run(runner: Runner, temp_config: TempConfig, add_pre: Operation = Empty()) -
     ovito_dir       = artifacts_dir / 'ovito'
     af_src_file     = artifacts_dir / f'AutoFeram_{src_file.name}'
     parquet_file    = artifacts_dir / f'{sim_name}.parquet'
+    stats_file      = artifacts_dir / f'{sim_name}.stats.parquet'
+    trajectory_file = artifacts_dir / f'{sim_name}.trajectory.npz'
 
     pre = OperationSequence([
         Message('Pre'),
@@ -38,17 +53,19 @@ def run(runner: Runner, temp_config: TempConfig, add_pre: Operation = Empty()) -
         add_pre
     ])
 
+    def step_config(temperature: int) -> FeramConfig:
+        step_config = deepcopy(config)
+        step_config.setup['kelvin'] = temperature
+        return step_config
+
     def step(temperature: int) -> OperationSequence:
         temp_coord_file    = coord_dir / f'{temperature}.coord'
         temp_dipoRavg_file = dipoRavg_dir / f'{temperature}.dipoRavg'
 
-        step_config = deepcopy(config)
-        step_config.setup['kelvin'] = temperature
-
         return OperationSequence([
             Message(f'Temperature: {temperature}'),
-            Write(FileOut(feram_file), step_config.generate_feram_file),
-            Feram(Exec(feram_bin), FileIn(feram_file)),
+            Write(FileOut(feram_file), step_config(temperature).generate_feram_file),
+            Feram(Exec(feram_bin), FileIn(feram_file), cache=cache),
             Append(FileIn(avg_file), FileOut(thermo_file)),
             Remove(FileIn(avg_file)),
             Rename(FileIn(dipoRavg_file), FileOut(temp_dipoRavg_file)),
@@ -56,26 +73,140 @@ def run(runner: Runner, temp_config: TempConfig, add_pre: Operation = Empty()) -
             Rename(FileIn(last_coord_file), FileOut(temp_coord_file)),
         ])
 
-    main = OperationSequence(map(step, temps))
+    def chain(chain_temps: Sequence[int], start: Operation = Empty()) -> OperationSequence:
+        '''Run temperatures serially in their own directory, restarting each from the previous one.
+        Outputs are kept as {temperature}.{ext} until they are merged.'''
+        chain_dir = chains_dir / f'{chain_temps[0]}'
+
+        def copy_inputs() -> Operation:
+            # auxiliary inputs written by add_pre, e.g. .modulation, .localfield, .restart
+            return OperationSequence(Copy(FileIn(file), FileOut(chain_dir / file.name))
+                                     for file in output_dir.glob(f'{sim_name}.*'))
+
+        def chain_step(temperature: int) -> OperationSequence:
+            chain_feram_file = chain_dir / feram_file.name
+            chain_last_coord = chain_dir / last_coord_file.name
+
+            return OperationSequence([
+                Message(f'Temperature: {temperature}'),
+                Write(FileOut(chain_feram_file), step_config(temperature).generate_feram_file),
+                Feram(Exec(feram_bin), FileIn(chain_feram_file), cache=cache),
+                Rename(FileIn(chain_dir / avg_file.name), FileOut(chain_dir / f'{temperature}.avg')),
+                Rename(FileIn(chain_dir / json_file.name), FileOut(chain_dir / f'{temperature}.json')),
+                Rename(FileIn(chain_dir / dipoRavg_file.name), FileOut(chain_dir / f'{temperature}.dipoRavg')),
+                Copy(FileIn(chain_last_coord), FileOut(chain_dir / restart_file.name)),
+                Rename(FileIn(chain_last_coord), FileOut(chain_dir / f'{temperature}.coord')),
+            ])
+
+        return OperationSequence([
+            MkDirs(DirOut(chain_dir)),
+            Lazy(copy_inputs),
+            start,
+            *map(chain_step, chain_temps)
+        ])
+
+    def chain_start(temperature: int) -> Operation:
+        '''Prepare the restart file of a sub-ladder that doesn't continue from the temperature above it.'''
+        chain_dir          = chains_dir / f'{temperature}'
+        chain_restart_file = chain_dir / restart_file.name
+        library_coord      = pool.restart_library / f'{temperature}.coord' if pool.restart_library else None
+
+        if library_coord and library_coord.is_file():
+            return Copy(FileIn(library_coord), FileOut(chain_restart_file))
+        elif pool.n_equilibrate > 0:
+            eq_config = step_config(temperature)
+            eq_config.setup |= dict(n_thermalize = pool.n_equilibrate, n_average = 0, n_coord_freq = pool.n_equilibrate)
+            eq_feram_file = chain_dir / feram_file.name
+
+            return OperationSequence([
+                Message(f'Equilibrate: {temperature}'),
+                Write(FileOut(eq_feram_file), eq_config.generate_feram_file),
+                Feram(Exec(feram_bin), FileIn(eq_feram_file), cache=cache),
+                Rename(FileIn(chain_dir / f'{sim_name}.{eq_config.last_coord}.coord'), FileOut(chain_restart_file)),
+            ])
+        else:
+            return Empty()
+
+    def merge(chain_temps: Sequence[int]) -> OperationSequence:
+        '''Move the outputs of a chain to the same place as a serial sweep.'''
+        chain_dir = chains_dir / f'{chain_temps[0]}'
+
+        def merge_step(temperature: int) -> OperationSequence:
+            return OperationSequence([
+                Append(FileIn(chain_dir / f'{temperature}.avg'), FileOut(thermo_file)),
+                Remove(FileIn(chain_dir / f'{temperature}.avg')),
+                Rename(FileIn(chain_dir / f'{temperature}.dipoRavg'), FileOut(dipoRavg_dir / f'{temperature}.dipoRavg')),
+                Rename(FileIn(chain_dir / f'{temperature}.coord'), FileOut(coord_dir / f'{temperature}.coord')),
+            ])
+
+        return OperationSequence(map(merge_step, chain_temps))
+
+    if resume and (pool.max_workers > 1 or pool.segments):
+        main = Operation(lambda: Err('resume: not supported with a SweepPool, resume with SweepPool() instead'))
+    elif pool.max_workers > 1 or pool.segments:
+        chains     = split_ladder(temps, pool.segments or pool.max_workers)
+        starts     = [Empty(), *(chain_start(chain_temps[0]) for chain_temps in chains[1:])]
+        last_temp  = chains[-1][-1]
+        last_chain = chains_dir / f'{chains[-1][0]}'
+
+        main = OperationSequence([
+            Parallel(map(chain, chains, starts), max_workers=pool.max_workers),
+            Message('Merge'),
+            *map(merge, chains),
+            # leave the same files behind as the serial sweep: those of the last temperature (.feram, .log, .stdout, .restart, ...)
+            Copy(FileIn(last_chain / f'{last_temp}.json'), FileOut(json_file)),
+            Lazy(lambda: OperationSequence(Copy(FileIn(file), FileOut(output_dir / file.name))
+                                           for file in last_chain.glob(f'{sim_name}.*'))),
+            RemoveDir(DirIn(chains_dir)),
+        ])
+    else:
+        def journal_step(temperature: int) -> Step:
+            return Step(
+                name      = f'temperature/{temperature}',
+                operation = step(temperature),
+                outputs   = [coord_dir / f'{temperature}.coord', dipoRavg_dir / f'{temperature}.dipoRavg'],
+                restart   = restart_file,
+                appends   = [thermo_file]
+            )
+
+        main = Lazy(lambda: resume_steps(journal, list(map(journal_step, temps))))
+
+    # coords and dipoRavgs run concurrently, each with half of the CPUs
+    ovito_workers = max(1, (os.cpu_count() or 1) // 2)
+
+    def trajectory_frames() -> list[tuple[Path, FrameInfo]]:
+        return [
+            *((coord_dir / f'{T}.coord', FrameInfo('coord', 'temperature', T, int(config.last_coord))) for T in temps),
+            *((dipoRavg_dir / f'{T}.dipoRavg', FrameInfo('dipoRavg', 'temperature', T, None)) for T in temps),
+        ]
 
     post = OperationSequence([
         Message('Post'),
-        Remove(FileIn(restart_file)),
+        Remove(FileIn(restart_file), missing_ok=resume),  # already removed if the run was interrupted in post
 
         MkDirs(DirOut(artifacts_dir)),
-        Copy(FileIn(src_file), FileOut(af_src_file)),
-
         MkDirs(DirOut(ovito_dir)),
-        WriteOvito(DirIn(coord_dir), FileOut(ovito_dir / 'coords.ovt'), 'coord'),
-        WriteOvito(DirIn(dipoRavg_dir), FileOut(ovito_dir / 'dipoRavgs.ovt'), 'dipoRavg'),
 
-        WriteParquet(FileOut(parquet_file), lambda: post_process_temp(runner, temp_config)),
-        Archive(DirIn(output_dir), FileOut(project_root() / 'output' / f'{output_dir.name}.tar.gz'))
+        OperationGraph({
+            'source':     Node(Copy(FileIn(src_file), FileOut(af_src_file))),
+            'coords':     Node(WriteOvito(DirIn(coord_dir), FileOut(ovito_dir / 'coords.ovt'), 'coord', max_workers=ovito_workers)),
+            'dipoRavgs':  Node(WriteOvito(DirIn(dipoRavg_dir), FileOut(ovito_dir / 'dipoRavgs.ovt'), 'dipoRavg', max_workers=ovito_workers)),
+            'parquet':    Node(WriteParquet(FileOut(parquet_file), lambda: post_process_temp(runner, temp_config))),
+            'trajectory': Node(WriteTrajectory(FileOut(trajectory_file), trajectory_frames,
+                                               {'sim_name': sim_name, 'config': config_metadata(config)})),
+            'stats':      Node(WriteStatistics(FileOut(stats_file), trajectory_frames, config.polarization_parameters.factor)),
+            # left out: the trajectory, which repeats the frames of the run and is rebuilt from them by WriteTrajectory,
+            # and the journal, which is only there to resume the run
+            'archive':    Node(Archive(DirIn(output_dir), FileOut(project_root() / 'output' / f'{output_dir.name}.tar.gz'),
+                                       exclude = lambda path: path in (trajectory_file, journal.path, journal.start_file)),
+                               after = ['source', 'coords', 'dipoRavgs', 'parquet', 'trajectory', 'stats']),
+        })
     ])
 
     return OperationSequence([
         pre,
         Message('Main'),
+        OpenJournal(journal, resume),
         main,
         post,
         Success(src_file.name)
@@ -84,10 +215,12 @@ def run(runner: Runner, temp_config: TempConfig, add_pre: Operation = Empty()) -
 
 
 if __name__ == "__main__":
+    resume_dir = resume_from_cmd_line()
+
     runner = Runner(
         sim_name    = 'bto',
         feram_path  = feram_with_fallback(Path.home() / 'feram_dev/build/src/feram'),
-        output_dir  = project_root() / 'output' / f'temperature_{timestamp()}',
+        output_dir  = resume_dir or project_root() / 'output' / f'temperature_{timestamp()}',
     )
 
     config = temp_config(
@@ -110,4 +243,4 @@ if __name__ == "__main__":
         ]
     )
 
-    exit_from_result(run(runner, config))
+    exit_from_result(run(runner, config, resume = resume_dir is not None))
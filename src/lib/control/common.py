@@ -1,11 +1,14 @@
+import numpy as np
 import polars as pl
 from pathlib import Path
-from typing import Any, NamedTuple
+from typing import Any, NamedTuple, Optional
 from collections.abc import Iterable, Mapping, Sequence
 from itertools import accumulate
 
 from src.lib.common import BoltzmannConst
 from src.lib.Config import FeramConfig, Material, Setup, SetupDict, merge_setups
+from src.lib.Schema import LOG_SCHEMA
+from src.lib.Phase import phase_series
 
 
 class Runner(NamedTuple):
@@ -19,6 +22,20 @@ class TempRange(NamedTuple):
     final: int
     delta: int
 
+class SweepPool(NamedTuple):
+    max_workers: int = 1                   # 1: serial sweep, otherwise number of concurrent feram runs
+    segments: Optional[int] = None         # split the temperature ladder into this many chained sub-ladders; None: one per worker.
+                                           # len(temps): every temperature on its own, without restarting from the one before
+    n_equilibrate: int = 0                 # steps to equilibrate a sub-ladder at its first temperature, when restart_library has no .coord for it
+    restart_library: Optional[Path] = None # directory of {temperature}.coord files, e.g. coords/ of an earlier sweep
+
+def split_ladder(temps: Sequence[int], segments: int) -> list[Sequence[int]]:
+    '''Cut temps into (at most) segments contiguous sub-ladders of near-equal length.'''
+    size, rest = divmod(len(temps), segments)
+    bounds     = [i * size + min(i, rest) for i in range(segments + 1)]
+
+    return [temps[a:b] for a, b in zip(bounds, bounds[1:]) if b > a]
+
 class TempConfig(NamedTuple):
     material: Material
     temp_range: range
@@ -34,6 +51,15 @@ def temp_config(material: Material, temp_range: TempRange, setup: Sequence[Setup
         )
     )
 
+def phases(df: pl.DataFrame, config: FeramConfig) -> pl.Series:
+    '''Phase of every time step of df (a feram log), from <u> as polarization; null where <u> is not logged.'''
+    valid    = df['u'].list.len().eq(3).fill_null(False).to_numpy()
+    u        = np.full((len(df), 3), np.nan)
+    u[valid] = np.array(df['u'].filter(valid).to_list(), dtype=np.float64).reshape(-1, 3)
+
+    return phase_series(u * config.polarization_parameters.factor).scatter(np.flatnonzero(~valid), None)
+
+
 def post_process_temp(runner: Runner, config: TempConfig) -> pl.DataFrame:
     sim_name, working_dir, _ = runner
     json_name = f'{sim_name}.json'
@@ -53,7 +79,8 @@ def post_process_temp(runner: Runner, config: TempConfig) -> pl.DataFrame:
     return df.with_columns(
         dt_fs   = pl.lit(dt),
         time_fs = pl.Series(time),
-        kelvin  = pl.col('dipo_kinetic') / (1.5 * BoltzmannConst)
+        kelvin  = pl.col('dipo_kinetic') / (1.5 * BoltzmannConst),
+        phase   = phases(df, config.config)
     )
 
 
@@ -78,15 +105,16 @@ def post_process_ece(runner: Runner, config: ECEConfig) -> pl.DataFrame:
     sim_name, working_dir, _ = runner
     json_name = f'{sim_name}.json'
 
-    def mk_df(step_dir: str, setup: SetupDict) -> pl.DataFrame:
+    def mk_df(step_dir: str, feram_config: FeramConfig) -> pl.DataFrame:
         df = pl.read_json(working_dir / step_dir / json_name, schema = LOG_SCHEMA)[1:]
 
         return df.with_columns(
             step  = pl.lit(step_dir),
-            dt_fs = pl.lit(setup['dt'] * 1000)
+            dt_fs = pl.lit(feram_config.setup['dt'] * 1000),
+            phase = phases(df, feram_config)
         )
 
-    merged_df = pl.concat([mk_df(step_dir, config.setup) for step_dir, config in config.steps.items()])
+    merged_df = pl.concat([mk_df(step_dir, feram_config) for step_dir, feram_config in config.steps.items()])
     time      = pl.Series(accumulate(merged_df['dt_fs'], lambda acc, x: acc + x))
     time_adj  = time - merged_df['dt_fs'][0]  # make time_fs start from 0
 
@@ -94,27 +122,3 @@ def post_process_ece(runner: Runner, config: ECEConfig) -> pl.DataFrame:
         time_fs = pl.Series(time_adj),
         kelvin  = pl.col('dipo_kinetic') / (1.5 * BoltzmannConst)
     )
-
-
-LOG_SCHEMA: dict[str, pl.DataTypeClass] = {
-    'time_step':       pl.Int64,
-    'acou_kinetic':    pl.Float64,
-    'dipo_kinetic':    pl.Float64,
-    'short_range':     pl.Float64,
-    'long_range':      pl.Float64,
-    'dipole_E_field':  pl.Float64,
-    'unharmonic':      pl.Float64,
-    'homo_strain':     pl.Float64,
-    'homo_coupling':   pl.Float64,
-    'inho_strain':     pl.Float64,
-    'inho_coupling':   pl.Float64,
-    'inho_modulation': pl.Float64,
-    'total_energy':    pl.Float64,
-    'H_Nose_Poincare': pl.Float64,
-    's_Nose':          pl.Float64,
-    'pi_Nose':         pl.Float64,
-    'u':               pl.List(pl.Float64),
-    'u_sigma':         pl.List(pl.Float64),
-    'p':               pl.List(pl.Float64),
-    'p_sigma':         pl.List(pl.Float64),
-}
@@ -0,0 +1,102 @@
+'''
+Compare the streaming .log parsers of Log with the parsy parser they replaced, on a feram .log file.
+
+python -m src.lib.misc.benchmark_log [bto.log]
+'''
+
+import sys
+import time
+import tracemalloc
+import polars as pl
+from pathlib import Path
+from parsy import Parser, seq, any_char, whitespace, string, regex
+
+from src.lib.common import Vec3
+from src.lib.Log import TimeStep, parse_log, read_log, read_log_polars, time_steps_to_polars
+from src.lib.Util import project_root
+
+
+def parse_log_parsy(log: str) -> pl.DataFrame:
+    '''The parse_log of before the streaming parser, as the reference.'''
+    floating       = regex(r'\-?\d+\.\d+').map(float)
+    integer        = regex(r'\d+').map(int)
+    any_char_until = any_char.until
+
+    def float_element(token: str) -> Parser:
+        tok = any_char_until(string(token)) >> string(token)
+        flt = whitespace >> floating
+
+        return (tok >> flt).optional().map(lambda v: (token, v)).desc(token)
+
+    def vector_element(name: str, token: str) -> Parser:
+        tok = any_char_until(string(token)) >> string(token)
+        vec = whitespace >> seq(floating << whitespace, floating << whitespace, floating).map(Vec3._make)
+
+        return (tok >> vec).optional().map(lambda v: (name, v)).desc(token)
+
+    ts_start    = any_char_until(string('TIME_STEP')).desc('ts_start')
+    ts_end      = any_char_until(string('TIME_STEP_END'), consume_other=True).concat().desc('ts_end')
+    ts_section  = (ts_start >> ts_end).desc('ts_section')
+    ts_sections = ts_section.many().desc('ts_sections')
+    time_step   = (string('TIME_STEP') >> whitespace >> integer).map(lambda v: ('time_step', v)).desc('time_step')
+
+    def parse_ts_section(ts_section: str) -> TimeStep:
+        ts_fields = seq(
+            time_step,
+            *map(float_element,
+                 ['acou_kinetic',
+                  'dipo_kinetic',
+                  'short_range',
+                  'long_range',
+                  'dipole_E_field',
+                  'unharmonic',
+                  'homo_strain',
+                  'homo_coupling',
+                  'inho_strain',
+                  'inho_coupling',
+                  'inho_modulation',
+                  'total_energy',
+                  'H_Nose_Poincare',
+                  's_Nose',
+                  'pi_Nose']),
+            *map(lambda tup: vector_element(tup[0], tup[1]),
+                 [('u', '<u>'),
+                  ('u_sigma', 'sigma'),
+                  ('p', '<p>'),
+                  ('p_sigma', 'sigma')])
+        )
+
+        return ts_fields.combine_dict(TimeStep).parse_partial(ts_section)[0]
+
+    ts_sections_res = ts_sections.parse_partial(log)[0]
+
+    return time_steps_to_polars(list(map(parse_ts_section, ts_sections_res)))
+
+
+def benchmark(log_path: Path) -> None:
+    '''Compare parse_log_parsy with parse_log and read_log_polars on a log file.'''
+    def measure(name: str, f):
+        start   = time.perf_counter()
+        df      = f()
+        elapsed = time.perf_counter() - start
+
+        # second run, as tracing allocations slows the first one down
+        tracemalloc.start()
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f'{name:<16} {elapsed:8.3f} s {peak / 2**20:10.1f} MiB peak (Python heap)')
+        return df
+
+    reference = measure('parse_log_parsy', lambda: parse_log_parsy(read_log(log_path)))
+    parsed    = measure('parse_log',       lambda: parse_log(read_log(log_path)).to_polars())
+    streamed  = measure('read_log_polars', lambda: read_log_polars(log_path))
+
+    print(f'{len(reference)} time steps, identical: {reference.equals(parsed) and reference.equals(streamed)}')
+
+
+if __name__ == "__main__":
+    log_path = Path(sys.argv[1]) if len(sys.argv) > 1 else project_root() / 'output' / 'temp' / 'bto.log'
+
+    benchmark(log_path)
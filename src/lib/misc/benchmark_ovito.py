@@ -0,0 +1,72 @@
+'''
+Compare Ovito.write_dump, which formats the atoms of a frame as one block, with the row by row formatting it replaced.
+
+python -m src.lib.misc.benchmark_ovito [coords dir] [.modulation file]
+'''
+
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from collections.abc import Sequence
+from typing import Optional
+from numpy.typing import NDArray
+
+from src.lib.Ovito import dump_header, parse_dipo_df, parse_mod, vorticity3d_df, write_dump
+from src.lib.Util import project_root
+
+
+def dump_atoms_scalar(df: pd.DataFrame, modulation: NDArray, atom_types: dict) -> str:
+    '''Reference for Ovito.dump_atoms, one row at a time.'''
+    x, y, z       = df.x, df.y, df.z
+    ux, uy, uz    = df.ux, df.uy, df.uz
+    vtx, vty, vtz = df.vtx, df.vty, df.vtz
+
+    return ''.join(
+        f'{j + 1:d} {atom_types[modulation[j]]:d} {modulation[j]:d} '
+        f'{int(x[j]):d} {int(y[j]):d} {int(z[j]):d} '
+        f'{ux[j]:.6f} {uy[j]:.6f} {uz[j]:.6f} '
+        f'{vtx[j]:.6f} {vty[j]:.6f} {vtz[j]:.6f}\n'
+        for j in range(len(df))
+    )
+
+def write_dump_scalar(dump_path: Path, dipo_files: Sequence[Path], mod_file: Optional[Path]):
+    '''Reference for Ovito.write_dump, serial and formatting with dump_atoms_scalar.'''
+    modulation = parse_mod(mod_file)[:, 3] if mod_file else np.array([0])
+    atom_types = { t: i + 1 for i, t in enumerate(np.unique(modulation)) }
+
+    with open(dump_path, 'w') as dump:
+        for i, dipo_file in enumerate(dipo_files):
+            df = vorticity3d_df(parse_dipo_df(dipo_file), dx = 1, dy = 1, dz = 1)
+            dump.write(dump_header(i, dipo_file, df) +
+                       dump_atoms_scalar(df, modulation if mod_file else np.repeat(0, len(df)), atom_types))
+
+
+def benchmark(dipo_dir: Path, ext: str = 'coord', mod_file: Optional[Path] = None) -> None:
+    '''Compare write_dump with write_dump_scalar on the frames in dipo_dir, both in one process.'''
+    dipo_files = sorted(dipo_dir.glob(f'*.{ext}'))
+
+    for dipo_file in dipo_files:
+        parse_dipo_df(dipo_file)  # both then read the frames from the cache, see Coord.load_frame
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def measure(name: str, write) -> bytes:
+            dump_path = Path(tmp) / f'{name}.ovt'
+            start     = time.perf_counter()
+            write(dump_path, dipo_files, mod_file)
+            print(f'{name:<18} {time.perf_counter() - start:8.3f} s')
+            return dump_path.read_bytes()
+
+        reference  = measure('write_dump_scalar', write_dump_scalar)
+        vectorized = measure('write_dump', write_dump)
+
+    print(f'{len(dipo_files)} frames, identical: {reference == vectorized}')
+
+
+if __name__ == "__main__":
+    dipo_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else project_root() / 'output' / 'temp' / 'coords'
+    mod_file = Path(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    benchmark(dipo_dir, mod_file = mod_file)